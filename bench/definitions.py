@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks decoding and encoding Feeds of definitions: time to read a
+feed from JSON and to write it back, and the memory held by the decoded
+feed. Run from the repository root::
+
+    python bench/definitions.py [entries]
+"""
+
+import gc
+import sys
+import json
+import time
+import tracemalloc
+
+sys.path.insert(0, '.')
+
+from radiant.grid.backend.definition import Feed, DataDefinition,\
+    VariableDefinition
+
+
+def rows(n):
+    return {
+        'data-type': 'grid/data/feed',
+        'workspace': 'bench',
+        'start': 0,
+        'count': n,
+        'page-size': n,
+        'entries': [{'name': 'item%06i' % i, 'price': i * 1.5, 'qty': i}
+                    for i in range(n)],
+    }
+
+
+def variables(n):
+    return {
+        'data-type': 'grid/variable/feed',
+        'workspace': 'bench',
+        'count': n,
+        'entries': [{'data-type': 'grid/variable/entry',
+                     'name': 'var.%06i' % i, 'type': 'int', 'value': i}
+                    for i in range(n)],
+    }
+
+
+def encoded_rows(n):
+    # What a feed of rows(n) has always been written back as
+    return {
+        'data-type': 'grid/data/feed',
+        'workspace': 'bench',
+        'start': 0,
+        'count': n,
+        'page-size': n,
+        'next-cursor': None,
+        'total': None,
+        'entries': [{'data-type': 'grid/data/entry',
+                     'data': {'name': 'item%06i' % i, 'price': i * 1.5, 'qty': i}}
+                    for i in range(n)],
+    }
+
+
+def encoded_variables(n):
+    return {
+        'data-type': 'grid/variable/feed',
+        'workspace': 'bench',
+        'start': 0,
+        'count': n,
+        'page-size': 0,
+        'next-cursor': None,
+        'total': None,
+        'entries': [{'data-type': 'grid/variable/entry',
+                     'name': 'var.%06i' % i, 'type': 'int', 'value': i}
+                    for i in range(n)],
+    }
+
+
+def decode(entry_class, data):
+    if hasattr(Feed, 'from_json'):
+        return Feed.from_json(entry_class, data)
+    return Feed(entry_class, json.loads(data.decode('utf8')))
+
+
+def encode(feed):
+    if hasattr(feed, 'to_json'):
+        return feed.to_json()
+    return json.dumps(feed.to_dict()).encode('utf8')
+
+
+def best(function, repeat=3):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        t = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def retained(function):
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main(n):
+    for label, entry_class, make, expected in (
+            ('data', DataDefinition, rows, encoded_rows),
+            ('variables', VariableDefinition, variables, encoded_variables)):
+        data = json.dumps(make(n)).encode('utf8')
+        feed = decode(entry_class, data)
+        assert encode(feed) == json.dumps(expected(n)).encode('utf8')
+        print("%-10s %i entries: decode %6.3fs  encode %6.3fs  memory %6.1f MB" % (
+            label, n,
+            best(lambda: decode(entry_class, data)),
+            best(lambda: encode(feed)),
+            retained(lambda: decode(entry_class, data)) / 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
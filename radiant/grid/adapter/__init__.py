@@ -1,3 +1,4 @@
 #!/usr/bin/env python3
 
 from .local import LocalAdapter
+from .http import HttpAdapter
@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import zlib
+import threading
+import http.client
+from collections import OrderedDict
+from urllib.parse import urlsplit, quote, urlencode
+
+from ..backend import DatabaseError
+from ..backend.definition import Feed, ChangeFeed, ViewDefinition,\
+    VariableDefinition, DocumentDefinition, DataDefinition, DataPage
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class HttpAdapter(object):
+    """
+    Adapter talking to a ``gridserver`` over HTTP, with the same surface
+    as :class:`LocalAdapter`.
+
+    Requests go over persistent connections, at most ``pool_size`` of
+    them. Definitions are cached together with their *ETag* and asked for
+    with *If-None-Match*, so an unchanged definition costs an empty *304*.
+    Idempotent requests that fail on the network, and any request the
+    server turned away with *503*, are retried up to ``retries`` times.
+    Several calls can share one round trip using :meth:`batch`. Responses
+    are asked for compressed, and rows in the *columns* layout, as
+    MessagePack when msgpack is installed.
+
+    :param str server: ``host:port`` or ``http://host:port`` of the server
+    :param str token: Sent as a bearer token with every request
+    """
+    def __init__(self, server, token=None, timeout=10.0, retries=2,
+                 pool_size=4, backoff=0.1, cache_size=256):
+        if '://' not in server:
+            server = 'http://' + server
+        url = urlsplit(server)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError("Unsupported scheme %s" % url.scheme)
+        self.server = server
+        self.token = token
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = HttpConnectionPool(url.scheme, url.hostname, url.port,
+                                       timeout, pool_size)
+        self.cache = ResponseCache(cache_size)
+        self.workspace = None
+
+    def close(self):
+        self.pool.close()
+
+    ### REQUESTS ###
+
+    def request(self, method, path, body=None, etag=None, idempotent=None):
+        """
+        Performs one request and returns ``(status, etag, data)``, ``data``
+        being the decoded JSON body if there is one. Raises
+        ``ConnectionError`` when the server can't be reached.
+        """
+        headers = {'Accept': ACCEPT, 'Accept-Encoding': 'gzip, deflate'}
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        if etag:
+            headers['If-None-Match'] = etag
+        if body is not None:
+            body = json.dumps(body).encode('utf8')
+            headers['Content-Type'] = 'application/json'
+
+        if idempotent is None:
+            idempotent = method in ('GET', 'PUT', 'DELETE')
+        attempt = 0
+        while True:
+            connection, reused = self.pool.acquire()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                self.pool.discard(connection)
+                # A kept-alive connection closed by the server fails the
+                # first request sent on it; that request never ran
+                stale = reused and isinstance(e, (
+                    http.client.RemoteDisconnected, BrokenPipeError,
+                    ConnectionResetError))
+                if attempt < self.retries and (idempotent or stale):
+                    attempt += 1
+                    time.sleep(self.backoff * attempt if not stale else 0)
+                    continue
+                raise ConnectionError("%s %s failed: %s" % (method, path, e))
+
+            if response.will_close:
+                self.pool.discard(connection)
+            else:
+                self.pool.release(connection)
+
+            if response.status == 503 and attempt < self.retries:
+                attempt += 1
+                time.sleep(self.backoff * attempt)
+                continue
+
+            return (response.status, response.getheader('ETag'),
+                    decode(response, content))
+
+    def call(self, method, path, body=None, cached=False):
+        """
+        Performs a request and returns its data, raising for errors. With
+        ``cached`` the response is kept by *ETag* and revalidated.
+        """
+        status, etag, data = self.request(
+            method, path, body, self.cache.etag(path) if cached else None)
+        try:
+            return self._result(path, status, etag, data, cached)
+        except LookupError:
+            # Evicted since asking, so ask again without the ETag
+            return self.call(method, path, body)
+
+    def _result(self, path, status, etag, data, cached):
+        if status == 304:
+            data = self.cache.get(path)
+            if data is None:
+                raise LookupError(path)
+            return data
+        check_status(status, path)
+        if cached and etag:
+            self.cache.put(path, etag, data)
+        return data
+
+    def batch(self, calls):
+        """
+        Performs several adapter calls in one round trip and returns their
+        results in order. ``calls`` is a list of tuples of a method name
+        and its arguments, for example
+        ``[('get_view', 'main'), ('get_variables',)]``. Raises the error
+        of the first failed call after all calls have run.
+        """
+        specs = [getattr(self, '_' + call[0])(*call[1:]) for call in calls]
+        entries = []
+        for spec in specs:
+            entry = {'method': spec.method, 'path': spec.path}
+            if spec.body is not None:
+                entry['body'] = spec.body
+            if spec.cached and self.cache.etag(spec.path):
+                entry['if-none-match'] = self.cache.etag(spec.path)
+            entries.append(entry)
+
+        # A batch is safe to repeat when nothing in it writes
+        status, _, data = self.request('POST', '/batch', {
+            'data-type': 'grid/batch/feed',
+            'entries': entries,
+        }, idempotent=all(spec.method == 'GET' for spec in specs))
+        check_status(status, '/batch')
+
+        results = []
+        error = None
+        for spec, result in zip(specs, data['entries']):
+            try:
+                try:
+                    data = self._result(spec.path, result['status'],
+                                        result['etag'], result['body'],
+                                        spec.cached)
+                except LookupError:
+                    data = self.call(spec.method, spec.path, spec.body)
+                results.append(spec.decode(data))
+            except Exception as e:
+                results.append(None)
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def _perform(self, spec):
+        return spec.decode(self.call(spec.method, spec.path, spec.body,
+                                     spec.cached))
+
+    def _path(self, *parts, **query):
+        path = '/workspace/' + '/'.join(quote(str(part), safe='')
+                                        for part in (self.workspace,) + parts)
+        query = {key.replace('_', '-'): value for key, value in query.items()
+                 if value is not None}
+        if query:
+            path += '?' + urlencode(sorted(query.items()))
+        return path
+
+    ### Workspace ###
+
+    def open_workspace(self, workspace):
+        self.workspace = workspace
+        try:
+            self.call('GET', self._path())
+        except NameError:
+            self.workspace = None
+            raise NameError("Workspace not found")
+
+    def create_workspace(self, workspace):
+        self.workspace = workspace
+        self.call('POST', self._path())
+
+    ### VIEW DEFINITION ###
+
+    def _create_view(self, view):
+        return Call('POST', self._path('view'), view.to_dict())
+
+    def _edit_view(self, name, view):
+        return Call('PUT', self._path('view', name), view.to_dict())
+
+    def _get_view(self, view):
+        return Call('GET', self._path('view', view), decode=ViewDefinition,
+                    cached=True)
+
+    def create_view(self, view):
+        self._perform(self._create_view(view))
+
+    def edit_view(self, name, view):
+        self._perform(self._edit_view(name, view))
+
+    def get_view(self, view):
+        return self._perform(self._get_view(view))
+
+    ### VARIABLE ###
+
+    def _create_variable(self, variable):
+        return Call('POST', self._path('variable'), variable.to_dict())
+
+    def _edit_variable(self, name, variable):
+        return Call('PUT', self._path('variable', name), variable.to_dict())
+
+    def _edit_variables(self, variables):
+        return Call('PUT', self._path('variable'), {
+            'data-type': 'grid/variable/feed',
+            'entries': [variable.to_dict() for variable in variables],
+        }, decode=lambda d: d['entries'] if d else [])
+
+    def _get_variable(self, name):
+        return Call('GET', self._path('variable', name),
+                    decode=VariableDefinition)
+
+    def _get_variables(self, prefix=None):
+        return Call('GET', self._path('variable', prefix=prefix),
+                    decode=lambda d: Feed(VariableDefinition, d))
+
+    def create_variable(self, variable):
+        self._perform(self._create_variable(variable))
+
+    def edit_variable(self, name, variable):
+        self._perform(self._edit_variable(name, variable))
+
+    def edit_variables(self, variables):
+        """
+        Sets the values of ``variables`` and returns the names of those
+        that don't exist.
+        """
+        try:
+            return self._perform(self._edit_variables(variables))
+        except NameError:
+            raise NameError("Variable does not exist")
+
+    def get_variable(self, name):
+        try:
+            return self._perform(self._get_variable(name))
+        except NameError:
+            raise NameError("Variable does not exist")
+
+    def get_variables(self, prefix=None):
+        return self._perform(self._get_variables(prefix))
+
+    ### DOCUMENT ###
+
+    def _create_document(self, document):
+        return Call('POST', self._path('document'), document.to_dict())
+
+    def _get_document(self, name):
+        return Call('GET', self._path('document', name),
+                    decode=DocumentDefinition, cached=True)
+
+    def _enum_documents(self):
+        def decode(d):
+            return Feed(str, data_type="grid/document/enum", d={
+                'data-type': "grid/document/enum",
+                'workspace': d['name'],
+                'entries': d['document-names'],
+                'count': len(d['document-names']),
+            })
+        return Call('GET', self._path(), decode=decode)
+
+    def create_document(self, document):
+        self._perform(self._create_document(document))
+
+    def get_document(self, name):
+        try:
+            return self._perform(self._get_document(name))
+        except NameError:
+            raise NameError("Document does not exist")
+
+    def enum_documents(self):
+        return self._perform(self._enum_documents())
+
+    ### ROWS ###
+
+    def _get_rows(self, document_name, start, count, cursor=None, query=None):
+        query = query or {}
+        where = query.get('where')
+        return Call('GET', self._path(
+            'document', document_name, 'data',
+            start=start, count=count, cursor=cursor, layout='columns',
+            columns=','.join(query['columns']) if query.get('columns') else None,
+            order_by=','.join(query['order-by']) if query.get('order-by') else None,
+            where=json.dumps(where) if where else None,
+        ), decode=lambda d: DataPage(d, self._columns(document_name)))
+
+    def _columns(self, document_name):
+        # The column types, as the local adapter has them, from the
+        # document's cached copy if there is one
+        data = self.cache.get(self._path('document', document_name))
+        if data is not None:
+            return DocumentDefinition(data).columns
+        return self.get_document(document_name).columns
+
+    def get_rows(self, document_name, start, count, cursor=None, query=None):
+        return self._perform(self._get_rows(document_name, start, count,
+                                            cursor, query))
+
+    def _aggregate(self, document_name, aggregation):
+        where = aggregation.get('where')
+        return Call('GET', self._path(
+            'document', document_name, 'aggregate',
+            aggregates=','.join(
+                aggregate['function'] + ('' if aggregate.get('column', '*') == '*'
+                                         else ':' + aggregate['column'])
+                for aggregate in aggregation['aggregates']),
+            group_by=','.join(aggregation['group-by']) if aggregation.get('group-by') else None,
+            where=json.dumps(where) if where else None,
+        ), decode=lambda d: Feed(DataDefinition, d, 'grid/aggregate/feed'),
+            cached=True)
+
+    def aggregate(self, document_name, aggregation):
+        return self._perform(self._aggregate(document_name, aggregation))
+
+    ### CHANGES ###
+
+    def _get_changes(self, since=0, document_name=None, limit=1000):
+        return Call('GET', self._path('changes', since=since,
+                                      document=document_name, limit=limit),
+                    decode=ChangeFeed)
+
+    def get_changes(self, since=0, document_name=None, limit=1000):
+        return self._perform(self._get_changes(since, document_name, limit))
+
+
+class Call(object):
+    """
+    One adapter call as a request: what to send and how to decode the
+    answer.
+    """
+    __slots__ = ('method', 'path', 'body', 'decode', 'cached')
+
+    def __init__(self, method, path, body=None, decode=None, cached=False):
+        self.method = method
+        self.path = path
+        self.body = body
+        self.decode = decode or (lambda d: d)
+        self.cached = cached
+
+
+ACCEPT = 'application/json'
+if msgpack is not None:
+    ACCEPT = 'application/msgpack, application/json;q=0.9'
+
+
+def decode(response, content):
+    """
+    Returns the JSON or MessagePack body of a response, decompressed, or
+    ``None`` if it has none.
+    """
+    encoding = response.getheader('Content-Encoding')
+    if encoding == 'gzip':
+        content = zlib.decompress(content, 31)
+    elif encoding == 'deflate':
+        content = zlib.decompress(content, 15)
+    if not content:
+        return None
+    content_type = response.getheader('Content-Type', '')
+    if content_type.startswith('application/json'):
+        return json.loads(content.decode('utf8'))
+    if content_type.startswith('application/msgpack') and msgpack is not None:
+        return msgpack.unpackb(content, raw=False)
+    return None
+
+
+def check_status(status, path):
+    """
+    Raises for error statuses the way :class:`LocalAdapter` would.
+    """
+    if status < 400:
+        return
+    if status in (404, 409):
+        raise NameError("%s: %i" % (path, status))
+    if status in (400, 413, 416):
+        raise ValueError("%s: %i" % (path, status))
+    raise DatabaseError("%s: %i" % (path, status))
+
+
+class HttpConnectionPool(object):
+    """
+    Keeps up to ``size`` idle persistent connections to one server.
+    Connections are made when none is idle, so the pool limits what is
+    kept rather than what is used at once.
+    """
+    def __init__(self, scheme, host, port, timeout=10.0, size=4):
+        if scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Returns a connection and whether it has been used before.
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        connection = self.connection_class(self.host, self.port,
+                                           timeout=self.timeout)
+        return connection, False
+
+    def release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def discard(self, connection):
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class ResponseCache(object):
+    """
+    Least recently used response bodies by path, with their *ETag*.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def etag(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            return entry[0] if entry is not None else None
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return None
+            self._entries.move_to_end(path)
+            # Callers may change what they get
+            return json.loads(entry[1])
+
+    def put(self, path, etag, data):
+        with self._lock:
+            self._entries[path] = (etag, json.dumps(data))
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -2,8 +2,8 @@
 
 import os
 from ..backend import GridBackend, DatabaseError
-from ..backend.definition import Feed,\
-    ViewDefinition, VariableDefinition, DataDefinition
+from ..backend.definition import Feed, ChangeFeed, ViewDefinition,\
+    VariableDefinition, DocumentDefinition, DataDefinition, DataPage
 
 class LocalAdapter(object):
     def __init__(self, directory):
@@ -47,17 +47,27 @@ class LocalAdapter(object):
             self.backend.edit_variable(self.workspace, name, variable.to_dict())
         except DatabaseError:
             raise NameError("Variable exists")
-        
+
+    def edit_variables(self, variables):
+        # Returns the names of the variables that don't exist
+        try:
+            return self.backend.edit_variables(self.workspace, {
+                'data-type': 'grid/variable/feed',
+                'entries': [variable.to_dict() for variable in variables],
+            })['entries']
+        except DatabaseError:
+            raise NameError("Variable does not exist")
+
     def get_variable(self, name):
         try:
-            return VariableDefintion(
+            return VariableDefinition(
                 self.backend.get_variable(self.workspace, name))
         except DatabaseError:
             raise NameError("Variable does not exist")
 
-    def get_variables(self):
+    def get_variables(self, prefix=None):
         return Feed(VariableDefinition,
-            self.backend.get_variables(self.workspace))
+            self.backend.get_variables(self.workspace, prefix))
 
     ### DOCUMENT ### 
 
@@ -69,6 +79,7 @@ class LocalAdapter(object):
             document = self.backend.get_document(self.workspace, name)
         except DatabaseError:
             raise NameError("Document does not exist")
+        return DocumentDefinition(document)
 
     def enum_documents(self):
         return Feed(str, data_type="grid/document/enum",
@@ -77,6 +88,22 @@ class LocalAdapter(object):
 
     ### ROWS ###
 
-    def get_rows(self, document_name, start, count):
+    def get_rows(self, document_name, start, count, cursor=None, query=None):
+        document = self.get_document(document_name)
+        return DataPage(
+            self.backend.get_rows(self.workspace, document_name,
+                                  start, count, cursor, query,
+                                  layout='columns'),
+            document.columns)
+
+    def aggregate(self, document_name, aggregation):
         return Feed(DataDefinition,
-            self.backend.get_rows(document_name, start, count))
+            self.backend.aggregate(self.workspace, document_name, aggregation),
+            'grid/aggregate/feed')
+
+    ### CHANGES ###
+
+    def get_changes(self, since=0, document_name=None, limit=1000):
+        return ChangeFeed(
+            self.backend.get_changes(self.workspace, since, document_name,
+                                     limit))
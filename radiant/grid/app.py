@@ -3,6 +3,7 @@
 from ..tk import tk, ttk
 from .view import View
 from .workspace import Workspace
+from .scope import Dispatcher
 
 
 class GridApplication(ttk.Frame):
@@ -14,10 +15,12 @@ class GridApplication(ttk.Frame):
         self.parent.geometry('800x600+200+200')
         self.pack(fill=tk.BOTH, expand=1)
 
-        # Set up Workspace
+        # Set up Workspace, redrawing for variable changes when idle
         self.workspace = Workspace(
             directory="/tmp",
             workspace="test",
+            dispatcher=Dispatcher.tk(self),
+            lazy=True,
         )
         
         # Load the main view
@@ -125,6 +128,7 @@ class GridApplication(ttk.Frame):
     # Menu events
 
     def on_quit(self, *args):
+        self.workspace.close()
         self.quit()
 
     def on_save_view(self, *args):
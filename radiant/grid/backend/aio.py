@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .backend import GridBackend
+
+
+class AsyncGridBackend(object):
+    """
+    Asyncio facade for :class:`GridBackend`. Every method mirrors the
+    blocking method with the same name and returns a coroutine.
+
+    SQLite work runs on executors kept per workspace: one thread for
+    everything that writes, so writers are serialised, and up to
+    ``readers`` threads for reads running in parallel. At most
+    ``max_pending`` calls per workspace are queued or running; further
+    callers wait for a slot, which gives backpressure to the event loop.
+    Cancelling a call that has not started yet drops it, a call already
+    running in SQLite is left to finish.
+
+    :param backend: A :class:`GridBackend`, or a directory to create one for
+    """
+    def __init__(self, backend, readers=4, max_pending=256):
+        if not isinstance(backend, GridBackend):
+            backend = GridBackend(backend)
+        self.backend = backend
+        self.readers = readers
+        self.max_pending = max_pending
+        self._workspaces = {}
+        self._lock = threading.Lock()
+
+    def _executors(self, workspace):
+        with self._lock:
+            executors = self._workspaces.get(workspace)
+            if executors is None:
+                executors = WorkspaceExecutors(workspace, self.readers,
+                                               self.max_pending)
+                self._workspaces[workspace] = executors
+        return executors
+
+    async def _call(self, write, name, workspace, *args, **kwargs):
+        executors = self._executors(workspace)
+        function = functools.partial(getattr(self.backend, name),
+                                     workspace, *args, **kwargs)
+        async with executors.slots:
+            executor = executors.writer if write else executors.reader
+            return await asyncio.wrap_future(executor.submit(function))
+
+    async def enum_workspaces(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.backend.enum_workspaces)
+
+    async def export_rows(self, workspace, document, format='ndjson',
+                          chunk_size=1000):
+        """
+        Async generator version of :meth:`GridBackend.export_rows`, each
+        chunk is read on the workspace's reader executor.
+        """
+        chunks = await self._call(False, 'export_rows', workspace, document,
+                                  format, chunk_size)
+        done = object()
+        executors = self._executors(workspace)
+        while True:
+            async with executors.slots:
+                chunk = await asyncio.wrap_future(
+                    executors.reader.submit(next, chunks, done))
+            if chunk is done:
+                return
+            yield chunk
+
+    def close(self):
+        """
+        Shuts down the executors, waiting for the calls in progress.
+        """
+        with self._lock:
+            workspaces = list(self._workspaces.values())
+            self._workspaces.clear()
+        for executors in workspaces:
+            executors.shutdown()
+
+
+class WorkspaceExecutors(object):
+    """
+    The single writer thread, the reader threads and the pending call
+    slots of one workspace.
+    """
+    def __init__(self, workspace, readers, max_pending):
+        self.writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='grid-%s-writer' % workspace)
+        self.reader = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix='grid-%s-reader' % workspace)
+        self.slots = asyncio.Semaphore(max_pending)
+
+    def shutdown(self):
+        self.writer.shutdown(wait=True)
+        self.reader.shutdown(wait=True)
+
+
+def _mirror(name, write):
+    async def method(self, workspace, *args, **kwargs):
+        return await self._call(write, name, workspace, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Runs :meth:`GridBackend.%s` on the workspace's %s." % (
+        name, "writer" if write else "readers")
+    return method
+
+
+for _name in ('get_workspace', 'get_view', 'get_views', 'get_variable',
+              'get_variables', 'get_document', 'get_documents',
+              'enum_documents', 'get_indexes', 'get_rows', 'aggregate',
+              'get_changes', 'get_stamp'):
+    setattr(AsyncGridBackend, _name, _mirror(_name, False))
+
+for _name in ('create_workspace', 'create_view', 'edit_view',
+              'create_variable', 'edit_variable', 'edit_variables',
+              'create_document',
+              'delete_document', 'create_index', 'delete_index',
+              'edit_rows', 'edit_row', 'import_rows'):
+    setattr(AsyncGridBackend, _name, _mirror(_name, True))
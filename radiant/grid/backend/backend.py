@@ -3,22 +3,139 @@
 import sqlite3
 import re
 import os
+import io
+import csv
 import json
+import base64
+import time
+import threading
 from sqlite3 import IntegrityError, OperationalError
 from traceback import format_exc
+from .cache import MetadataCache
+from .journal import Journal
 
 EXTENSION = '.grid'
 
+# Defaults for the pragmas set on every workspace connection. WAL lets
+# readers carry on while a writer is busy.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -8000,
+    'mmap_size': 0,
+    'busy_timeout': 5000,
+}
+
+# Metadata kinds versioned in _grid_meta and the tables they are read from
+METADATA_TABLES = {
+    'docs': '_grid_docs',
+    'views': '_grid_views',
+    'vars': '_grid_vars',
+}
+
 
 class GridBackend(object):
-    def __init__(self, directory):
+    def __init__(self, directory, pool_size=8, idle_timeout=300.0,
+                 wait_timeout=30.0, pragmas=None, checkpoint_interval=300.0,
+                 metadata_ttl=1.0, journal_size=100000, compact_interval=60.0):
         self.directory = directory
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.pragmas = ConnectionPool.validate_pragmas(pragmas)
+        self.checkpoint_interval = checkpoint_interval
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self.metadata = MetadataCache(ttl=metadata_ttl)
+        self.journal_size = journal_size
+        self.compact_interval = compact_interval
+        self._compacted = {}
 
     def get_connection(self, workspace):
+        return self.get_pool(workspace).acquire()
+
+    def get_pool(self, workspace):
         workspace = Column.validate_name(workspace) + EXTENSION
-        db = sqlite3.connect(os.path.join(self.directory, workspace))
-        db.row_factory = sqlite3.Row
-        return db
+        with self._pools_lock:
+            pool = self._pools.get(workspace)
+            if pool is None:
+                pool = ConnectionPool(
+                    os.path.join(self.directory, workspace),
+                    size=self.pool_size,
+                    idle_timeout=self.idle_timeout,
+                    wait_timeout=self.wait_timeout,
+                    pragmas=self.pragmas,
+                    checkpoint_interval=self.checkpoint_interval,
+                    setup=self._setup_connection,
+                )
+                self._pools[workspace] = pool
+        return pool
+
+    def close(self):
+        with self._pools_lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+        self.metadata.clear()
+
+    def _setup_connection(self, db):
+        # Workspaces created before the _grid_meta and _grid_journal tables
+        # (or _grid_meta.update_ts) existed get them (and their triggers)
+        # the first time they are opened
+        tables = set(row['name'] for row in db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' " +
+            "AND name IN ('_grid_docs', '_grid_meta', '_grid_journal')"))
+        if '_grid_docs' not in tables:
+            return
+        stamped = '_grid_meta' in tables and 'update_ts' in set(
+            row['name'] for row in db.execute("PRAGMA table_info(_grid_meta)"))
+        upgrade = len(tables) < 3 or not stamped
+        # Recreate journal triggers that predate bulk-load suspension
+        unguarded = Journal.unguarded(db) if not upgrade else []
+        if upgrade or unguarded:
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                if '_grid_meta' in tables and not stamped:
+                    db.execute("ALTER TABLE _grid_meta ADD COLUMN update_ts INTEGER")
+                    for table in METADATA_TABLES.values():
+                        for event in ('insert', 'update', 'delete'):
+                            db.execute("DROP TRIGGER IF EXISTS %s_%s_version" % (
+                                table, event))
+                self._create_meta(db)
+                Journal.create(db)
+                for row in db.execute("SELECT name, data_model FROM _grid_docs").fetchall():
+                    if not upgrade and row['name'] not in unguarded:
+                        continue
+                    table = Table(json.loads(row['data_model']))
+                    Journal.drop_triggers(db, row['name'])
+                    Journal.create_triggers(db, row['name'],
+                                            [column.name for column in table.columns])
+                db.commit()
+            except OperationalError:
+                db.rollback()
+
+    def _create_meta(self, db):
+        # One version counter per metadata table, bumped by triggers on
+        # every change so that other processes' writes can be detected.
+        # The random epoch tells a recreated workspace from the old one.
+        db.execute("CREATE TABLE IF NOT EXISTS _grid_meta (" +
+                   "name TEXT(32) PRIMARY KEY, " +
+                   "version INTEGER DEFAULT 0, " +
+                   "update_ts INTEGER DEFAULT (strftime('%s', 'now')))"
+                  )
+        db.execute("INSERT OR IGNORE INTO _grid_meta (name, version, update_ts) " +
+                   "VALUES ('epoch', abs(random() % 4294967296), strftime('%s', 'now'))")
+        for kind, table in METADATA_TABLES.items():
+            db.execute("INSERT OR IGNORE INTO _grid_meta (name, update_ts) " +
+                       "VALUES (?, strftime('%s', 'now'))", (kind,))
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                db.execute("CREATE TRIGGER IF NOT EXISTS " +
+                           "%s_%s_version AFTER %s ON %s BEGIN " % (
+                               table, event.lower(), event, table) +
+                           "UPDATE _grid_meta SET version=version+1, " +
+                           "update_ts=strftime('%s', 'now') " +
+                           "WHERE name='" + kind + "'; END")
 
     def create_workspace(self, workspace):
         db = self.get_connection(workspace)
@@ -52,6 +169,8 @@ class GridBackend(object):
                        "gets TEXT(128), " +
                        "expires INTEGER)"
                       )
+            self._create_meta(db)
+            Journal.create(db)
             db.commit()
         except OperationalError as e:
             db.rollback()
@@ -91,6 +210,7 @@ class GridBackend(object):
                        "VALUES (?, ?, ?, ?)",
                        (name, "*", "*", json.dumps(view)))
             db.commit()
+            self.metadata.invalidate((workspace, 'views'))
         except IntegrityError as e:
             db.rollback()
             raise DatabaseError("View exists", e, format_exc())
@@ -110,6 +230,7 @@ class GridBackend(object):
                        "WHERE name=?",
                        (new_name, json.dumps(view_model, indent=2), old_name))
             db.commit()
+            self.metadata.invalidate((workspace, 'views'))
         except IntegrityError as e:
             db.rollback()
             raise DatabaseError("View exists", e, format_exc())
@@ -170,8 +291,44 @@ class GridBackend(object):
         finally:
             db.close()
 
+    def edit_variables(self, workspace, data):
+        """
+        Sets the values of the variables in a *grid/variable/feed* in one
+        transaction. Variables that don't exist (any more) are skipped and
+        returned by name as a *grid/variable/enum*.
+        """
+        assert data.get('data-type') == 'grid/variable/feed'
+        values = []
+        for variable in data.get('entries', []):
+            name = Column.validate_variable_name(variable.get('name'))
+            assert name is not None
+            values.append((variable.get('value'), name))
+
+        missing = []
+        db = self.get_connection(workspace)
+        try:
+            for value, name in values:
+                cur = db.execute("UPDATE _grid_vars " +
+                                 "SET update_ts=strftime('%s', 'now'), value=? " +
+                                 "WHERE name=?", (value, name))
+                if cur.rowcount == 0:
+                    missing.append(name)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        return {
+            'data-type': 'grid/variable/enum',
+            'workspace': workspace,
+            'entries': missing,
+            'count': len(missing),
+        }
+
     def get_variable(self, workspace, variable):
-        name = Column.validata_variable_name(variable)
+        name = Column.validate_variable_name(variable)
         assert name is not None
 
         variables = self._fetch_variables(workspace, variable=name)
@@ -180,8 +337,12 @@ class GridBackend(object):
         variable = variables.pop()
         return variable
 
-    def get_variables(self, workspace):
-        variables = self._fetch_variables(workspace)
+    def get_variables(self, workspace, prefix=None):
+        """
+        Returns the variables, or with ``prefix`` those in its namespace:
+        the variable ``prefix`` itself and all named ``prefix.*``.
+        """
+        variables = self._fetch_variables(workspace, prefix=prefix)
         return {
             'data-type': 'grid/variable/feed',
             'workspace': workspace,
@@ -200,9 +361,19 @@ class GridBackend(object):
 
         # Prepare Column SQL
         column_sql = []
+        column_names = []
         for cdata in columns:
             column = Column(cdata)
             column_sql.append(column.sql())
+            column_names.append(column.name)
+
+        # Prepare Index SQL
+        table = Table(document)
+        indexes = [Index(idata, table) for idata in document.get('indexes', [])]
+        if len(set(index.name for index in indexes)) != len(indexes):
+            raise ValueError('Index names must be unique')
+        if indexes:
+            document = dict(document, indexes=[index.to_dict() for index in indexes])
 
         db = self.get_connection(workspace)
         try:
@@ -212,7 +383,11 @@ class GridBackend(object):
                        (name, "*", "*", json.dumps(document)))
         
             db.execute("CREATE TABLE " + name + " (" + ', '.join(column_sql) + ')')
+            Journal.create_triggers(db, name, column_names)
+            for index in indexes:
+                db.execute(index.sql(name))
             db.commit()
+            self.metadata.invalidate((workspace, 'docs'))
         except IntegrityError as e:
             db.rollback()
             raise DatabaseError("Document exists", e, format_exc())
@@ -256,22 +431,92 @@ class GridBackend(object):
         try:
             db.execute("DELETE FROM _grid_docs WHERE name=?", (document,))
             db.execute("DROP TABLE " + document)
+            db.commit()
+            self.metadata.invalidate((workspace, 'docs'))
         except OperationalError as e:
             db.rollback()
             raise DatabaseError("Could not delete document", e, format_exc())
         finally:
             db.close()
 
+    def create_index(self, workspace, document, index):
+        if document.startswith('_'):
+            raise ValueError('Names starting with _ are reserved for internals')
+        document = Column.validate_name(document)
+
+        def change(model):
+            new = Index(index, Table(model))
+            indexes = model.get('indexes', [])
+            if any(i.get('name') == new.name for i in indexes):
+                raise DatabaseError("Index exists")
+            model['indexes'] = indexes + [new.to_dict()]
+            return new.sql(document)
+
+        self._edit_indexes(workspace, document, change)
+
+    def get_indexes(self, workspace, document):
+        indexes = self.get_document(workspace, document).get('indexes', [])
+        return {
+            'data-type': 'grid/index/feed',
+            'workspace': workspace,
+            'entries': indexes,
+            'count': len(indexes),
+        }
+
+    def delete_index(self, workspace, document, index):
+        if document.startswith('_'):
+            raise ValueError('Names starting with _ are reserved for internals')
+        document = Column.validate_name(document)
+        index = Column.validate_name(index)
+
+        def change(model):
+            indexes = model.get('indexes', [])
+            if not any(i.get('name') == index for i in indexes):
+                raise DatabaseError("No such index")
+            model['indexes'] = [i for i in indexes if i.get('name') != index]
+            return "DROP INDEX " + Index.sql_name(document, index)
+
+        self._edit_indexes(workspace, document, change)
+
+    def _edit_indexes(self, workspace, document, change):
+        # Read, change and write the data model in one write transaction
+        # so that concurrent index edits don't overwrite each other
+        db = self.get_connection(workspace)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT data_model FROM _grid_docs WHERE name=?",
+                             (document,)).fetchone()
+            if row is None:
+                raise DatabaseError("No such document")
+            model = json.loads(row['data_model'])
+            db.execute(change(model))
+            db.execute("UPDATE _grid_docs " +
+                       "SET update_ts=strftime('%s', 'now'), data_model=? " +
+                       "WHERE name=?",
+                       (json.dumps(model), document))
+            db.commit()
+            self.metadata.invalidate((workspace, 'docs'))
+        except OperationalError as e:
+            db.rollback()
+            raise DatabaseError("Could not edit index", e, format_exc())
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
     def edit_rows(self, workspace, document, data):
         assert data.get('data-type') == 'grid/instruction/feed'
 
         instruction_result = self._edit_rows(
             workspace, document, 
-            [Instruction(i) for i in data.get('instructions', [])]
+            [Instruction(i) for i in data.get('instructions', [])],
+            atomic=data.get('atomic', False)
         )
 
         return {
             'data-type': 'grid/instruction/feed',
+            'atomic': data.get('atomic', False),
             'instructions': [instruction.to_dict() 
                             for instruction in instruction_result]
         }
@@ -286,122 +531,736 @@ class GridBackend(object):
 
         return instruction_result.to_dict()
 
-    def get_rows(self, workspace, document, start, count):
+    def get_rows(self, workspace, document, start=0, count=20, cursor=None,
+                 query=None, total=False, layout='rows'):
+        """
+        Returns a page of rows as a *grid/data/feed*. With ``layout`` set to
+        ``columns`` the rows are not sent as *entries* but as the column
+        names (*columns*), one list of values per column (*values*) and
+        the rowids of the rows (*row-ids*), as found in the change journal.
+        """
         if document.startswith('_'):
             raise ValueError('Names starting with _ are reserved for internals')
+        if layout not in ('rows', 'columns'):
+            raise ValueError('Unknown layout %s' % layout)
         document = Column.validate_name(document)
         start = int(start)
         count = int(count)
 
-        rows = []
+        # Page by the sort columns and the primary key (or rowid) so that
+        # deep pages cost the same as the first one when the client
+        # follows the cursor
+        table = self._get_table(workspace, document)
+        query = Query(query, table)
+        after = None
+        if cursor is not None:
+            after, start = PageCursor.decode(cursor)
+
         db = self.get_connection(workspace)
         try:
-            cur = db.execute("SELECT * FROM " + document + 
-                             " LIMIT ? OFFSET ?", (count, start))
-            rows = cur.fetchall()
+            rows, last = self._read_page(db, document, table, count,
+                                         after=after, offset=start, query=query,
+                                         total=total)
+            if total:
+                total = self._page_total(db, document, query, rows, start,
+                                         after is not None)
+            else:
+                total = None
         finally:
             db.close()
 
-        return {
+        names = query.columns or [column.name for column in table.columns]
+
+        next_cursor = None
+        if count > 0 and len(rows) == count:
+            next_cursor = PageCursor.encode(last, start + len(rows))
+
+        feed = {
             'data-type': 'grid/data/feed',
             'workspace': workspace,
             'start': start,
             'count': len(rows),
             'page-size': count,
-            'entries': [{k: row[k] for k in row.keys()} for row in rows],
+            'next-cursor': next_cursor,
+            'total': total,
         }
-
-    def _edit_rows(self, workspace, document, instructions):
+        if layout == 'columns':
+            feed['layout'] = 'columns'
+            feed['columns'] = names
+            feed['values'] = [[row[name] for row in rows] for name in names]
+            feed['row-ids'] = [row['_grid_rowid'] for row in rows]
+        else:
+            feed['entries'] = [{name: row[name] for name in names} for row in rows]
+        return feed
+
+    def _page_total(self, db, document, query, rows, start, keyset):
+        # The page query counted the rows matching it in the same pass
+        # (see _read_page); following a cursor those are the rows from
+        # this page on, otherwise all of them
+        if rows:
+            return rows[0]['_grid_total'] + (start if keyset else 0)
+        if keyset or start == 0:
+            return start
+        where, params = query.where_sql()
+        sql = "SELECT COUNT(*) AS total FROM " + document
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return db.execute(sql, params).fetchone()['total']
+
+    def aggregate(self, workspace, document, data):
+        """
+        Runs an :class:`Aggregation` on a document and returns its result
+        rows as a *grid/aggregate/feed*.
+        """
         if document.startswith('_'):
             raise ValueError('Names starting with _ are reserved for internals')
         document = Column.validate_name(document)
+        table = self._get_table(workspace, document)
+        aggregation = Aggregation(data, table)
+        sql, params = aggregation.sql(document)
 
         db = self.get_connection(workspace)
         try:
-            for instruction in instructions:
-                instruction.perform(db, document)
+            rows = db.execute(sql, params).fetchall()
+        except OperationalError as e:
+            raise DatabaseError("Invalid document", e, format_exc())
         finally:
             db.close()
 
-        return instructions
+        names = aggregation.names()
+        return {
+            'data-type': 'grid/aggregate/feed',
+            'workspace': workspace,
+            'document': document,
+            'count': len(rows),
+            'entries': [{name: row[name] for name in names} for row in rows],
+        }
 
-    def _fetch_views(self, workspace, view=None, models=True):
-        view = Column.validate_name(view)
+    def export_rows(self, workspace, document, format='ndjson', chunk_size=1000):
+        """
+        Returns a generator of text chunks with every row of a document,
+        as NDJSON (one JSON object per line) or CSV with a header line.
+        Rows are read ``chunk_size`` at a time by key, and the connection
+        goes back to the pool between chunks.
+        """
+        if document.startswith('_'):
+            raise ValueError('Names starting with _ are reserved for internals')
+        document = Column.validate_name(document)
+        chunk_size = int(chunk_size)
+        if format not in ('ndjson', 'csv'):
+            raise ValueError('Unsupported format ' + str(format))
+        if chunk_size <= 0:
+            raise ValueError('Chunk size must be positive')
+
+        table = self._get_table(workspace, document)
+        names = [column.name for column in table.columns]
+        return self._export_rows(workspace, document, table, names,
+                                 format, chunk_size)
+
+    def _export_rows(self, workspace, document, table, names, format, chunk_size):
+        if format == 'csv':
+            out = io.StringIO()
+            writer = csv.writer(out)
+            writer.writerow(names)
+            yield out.getvalue()
+
+        after = None
+        while True:
+            db = self.get_connection(workspace)
+            try:
+                rows, last = self._read_page(db, document, table, chunk_size,
+                                             after=after)
+            finally:
+                db.close()
+
+            if rows:
+                if format == 'csv':
+                    out = io.StringIO()
+                    writer = csv.writer(out)
+                    writer.writerows([[row[name] for name in names]
+                                      for row in rows])
+                    yield out.getvalue()
+                else:
+                    yield ''.join([json.dumps({name: row[name] for name in names}) + '\n'
+                                   for row in rows])
+
+            if len(rows) < chunk_size:
+                return
+            after = last
+
+    def import_rows(self, workspace, document, stream, format='csv',
+                    chunk_size=5000, commit_size=100000, defer_indexes=False,
+                    progress=None):
+        """
+        Loads rows from a text stream of CSV (with a header line) or NDJSON
+        into a document. Column names are checked against the document's
+        data model once per distinct column set, rows are inserted with
+        ``executemany`` in chunks of ``chunk_size`` and committed every
+        ``commit_size`` rows. With ``defer_indexes`` the document's indexes
+        are dropped during the load and recreated at the end, except for
+        unique ones, which have to reject duplicates as they come.
+        ``progress`` is called with a *grid/import/progress* dict after
+        every commit.
+
+        The rows are not journaled one by one; the load ends with a single
+        ``reload`` entry for the document in the journal instead.
+        """
+        if document.startswith('_'):
+            raise ValueError('Names starting with _ are reserved for internals')
+        document = Column.validate_name(document)
+        chunk_size = int(chunk_size)
+        commit_size = max(int(commit_size), chunk_size)
+        if format not in ('ndjson', 'csv'):
+            raise ValueError('Unsupported format ' + str(format))
+        if chunk_size <= 0:
+            raise ValueError('Chunk size must be positive')
+
+        table = self._get_table(workspace, document)
+        loader = BulkLoader(table, format)
+
+        started = time.time()
+        rows = 0
+        uncommitted = 0
         db = self.get_connection(workspace)
+        try:
+            indexes = []
+            if defer_indexes:
+                deferred = [row['name'] for row in db.execute(
+                    "PRAGMA index_list(" + document + ")")
+                    if not row['unique'] and row['origin'] == 'c']
+                indexes = [index for index in db.execute(
+                    "SELECT name, sql FROM sqlite_master " +
+                    "WHERE type='index' AND tbl_name=? AND sql IS NOT NULL",
+                    (document,)).fetchall() if index['name'] in deferred]
+                for index in indexes:
+                    db.execute("DROP INDEX " + index['name'])
+            Journal.suspend(db, document)
+            db.commit()
+
+            try:
+                db.execute("BEGIN")
+                for columns, chunk in loader.chunks(stream, chunk_size):
+                    db.executemany(Instruction.insert_sql(document, columns), chunk)
+                    rows += len(chunk)
+                    uncommitted += len(chunk)
+                    if uncommitted >= commit_size:
+                        db.commit()
+                        uncommitted = 0
+                        if progress is not None:
+                            progress(self._import_status(
+                                'grid/import/progress', document, rows, started))
+                        db.execute("BEGIN")
+                db.commit()
+            except sqlite3.Error as e:
+                db.rollback()
+                raise DatabaseError("Import failed after %i rows" % (rows - uncommitted),
+                                    e, format_exc())
+            except:
+                db.rollback()
+                raise
+            finally:
+                try:
+                    for index in indexes:
+                        db.execute(index['sql'])
+                    db.commit()
+                except sqlite3.Error as e:
+                    db.rollback()
+                    raise DatabaseError("Could not recreate the indexes", e,
+                                        format_exc())
+                finally:
+                    Journal.resume(db, document)
+                    db.commit()
+            self._compact_journal(workspace, db)
+        finally:
+            db.close()
+
+        return self._import_status('grid/import/result', document, rows, started)
+
+    def _import_status(self, data_type, document, rows, started):
+        seconds = time.time() - started
+        return {
+            'data-type': data_type,
+            'document': document,
+            'rows': rows,
+            'seconds': seconds,
+            'rows-per-second': rows / seconds if seconds > 0 else 0.0,
+        }
+
+    def _read_page(self, db, document, table, count, after=None, offset=0,
+                   query=None, total=False):
+        """
+        Reads up to ``count`` rows matching ``query``, ordered by its sort
+        columns and then the primary key (or rowid). Either follows the
+        sort values in ``after`` (as returned for the last row of the
+        previous page) or skips ``offset`` rows. Returns the rows and the
+        sort values of the last one. With ``total`` every row also carries
+        the number of matching rows in *_grid_total*.
+        """
+        query = query or Query()
+        key = table.primary_key or 'rowid'
+        order = query.order_by + [(key, False)]
+        if after is not None and len(after) != len(order):
+            raise ValueError("Cursor does not match query")
+
+        select = ["%s AS _grid_key" % key, "rowid AS _grid_rowid"]
+        select += ["%s AS _grid_order%i" % (column, n)
+                   for n, (column, _) in enumerate(query.order_by)]
+        if total:
+            select.append("COUNT(*) OVER () AS _grid_total")
+        select += query.columns or ['*']
+
+        where, params = query.where_sql()
+        if after is not None:
+            condition, condition_params = Query.after_sql(order, after)
+            where.append(condition)
+            params += condition_params
+
+        sql = "SELECT " + ", ".join(select) + " FROM " + document
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY " + ", ".join([column + (" DESC" if descending else "")
+                                         for column, descending in order])
+        if after is not None:
+            sql += " LIMIT ?"
+            params += [count]
+        else:
+            sql += " LIMIT ? OFFSET ?"
+            params += [count, offset]
+
+        try:
+            rows = db.execute(sql, params).fetchall()
+        except OperationalError as e:
+            raise DatabaseError("Invalid document", e, format_exc())
+
+        last = None
+        if rows:
+            last = [rows[-1]['_grid_order%i' % n] for n in range(len(query.order_by))]
+            last.append(rows[-1]['_grid_key'])
+        return rows, last
 
-        views = []
-        column = 'data_model' if models else 'name'
+    def _get_table(self, workspace, document):
+        documents = self._fetch_documents(workspace, document=document)
+        if len(documents) == 0:
+            raise DatabaseError("No such document")
+        return Table(documents.pop())
+
+    def _edit_rows(self, workspace, document, instructions, atomic=False):
+        if document.startswith('_'):
+            raise ValueError('Names starting with _ are reserved for internals')
+        document = Column.validate_name(document)
+
+        db = self.get_connection(workspace)
         try:
-            if view is None:
-                c = db.execute("SELECT " + column + " FROM _grid_views")
+            # One transaction for the whole feed, each batch of instructions
+            # is isolated by a savepoint (see Instruction.perform_batch)
+            db.execute("BEGIN")
+            failed = False
+            for batch in Instruction.batches(instructions):
+                Instruction.perform_batch(db, document, batch)
+                if atomic and any(i.status is False for i in batch):
+                    failed = True
+                    break
+
+            if failed:
+                db.rollback()
+                for instruction in instructions:
+                    if instruction.status is not False:
+                        instruction.status = None
+                    instruction.affected_rows = 0
             else:
-                c = db.execute("SELECT " + column + " FROM _grid_views WHERE name=?",
-                               (view,))
+                db.commit()
+                self._compact_journal(workspace, db)
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
 
-            for row in c:
-                if models:
-                    views.append(json.loads(row['data_model']))
-                else:
-                    views.append(row['name'])
+        return instructions
 
+    def get_changes(self, workspace, since=0, document=None, limit=1000):
+        """
+        Returns the journaled changes after sequence number ``since`` as a
+        *grid/change/feed*, optionally only those for one document. Pass
+        the feed's *last-seq* as ``since`` to get the next changes. When
+        *reset* is set the journal has been compacted past ``since`` and
+        the client has to reload everything it holds.
+        """
+        since = int(since)
+        limit = int(limit)
+        if document is not None:
+            document = Column.validate_name(document)
+
+        db = self.get_connection(workspace)
+        try:
+            entries, last, watermark, more = Journal.changes(
+                db, since, document, limit)
         except OperationalError as e:
             raise DatabaseError("Invalid database", e, format_exc())
         finally:
             db.close()
-        return views
 
-    def _fetch_documents(self, workspace, document=None, models=True):
-        document = Column.validate_name(document)
+        return {
+            'data-type': 'grid/change/feed',
+            'workspace': workspace,
+            'since': since,
+            'last-seq': last,
+            'reset': since < watermark,
+            'more': more,
+            'count': len(entries),
+            'entries': entries,
+        }
+
+    def get_stamp(self, workspace, kind, document=None):
+        """
+        Returns a ``(tag, modified)`` tuple identifying the current state of
+        one kind of metadata (``docs``, ``views`` or ``vars``) or, with kind
+        ``data``, of the rows and definition of ``document``. The tag
+        changes with every change, ``modified`` is the time of the last
+        change (seconds since the epoch). Only ``_grid_meta`` and the
+        journal's index are read, so this is cheap enough for every request.
+        A cached copy of the metadata older than the tag is dropped.
+        """
+        if kind == 'data':
+            document = Column.validate_name(document)
+            assert document is not None
+            meta = 'journal'
+        elif kind in METADATA_TABLES:
+            meta = kind
+        else:
+            raise ValueError("Unknown kind %s" % kind)
+
         db = self.get_connection(workspace)
-        
-        documents = []
-        column = 'data_model' if models else 'name'
         try:
-            if document is None:
-                c = db.execute("SELECT " + column + " FROM _grid_docs")
-            else:
-                c = db.execute("SELECT " + column + " FROM _grid_docs WHERE name=?",
-                               (document,))
-            for row in c:
-                if models:
-                    documents.append(json.loads(row['data_model']))
-                else:
-                    documents.append(row['name'])
-
+            db.execute("BEGIN")
+            stamps = {row['name']: (row['version'], row['update_ts'])
+                      for row in db.execute(
+                          "SELECT name, version, update_ts FROM _grid_meta " +
+                          "WHERE name IN ('epoch', ?)", (meta,))}
+            # Once a document's entries are compacted away, the watermark
+            # (which is past them) stands in for them
+            latest = Journal.latest(db, document) if kind == 'data' else None
+            db.rollback()
         except OperationalError as e:
             raise DatabaseError("Invalid database", e, format_exc())
         finally:
             db.close()
-        return documents
-        
-    def _fetch_variables(self, workspace, variable=None):
-        variable = Column.validate_variable_name(variable)
+
+        if 'epoch' not in stamps or meta not in stamps:
+            raise DatabaseError("Invalid database")
+        version, modified = latest or stamps[meta]
+        if kind in ('docs', 'views'):
+            # What gets served under this tag must not be older than it
+            self.metadata.expire((workspace, kind), version)
+        return '"%x-%s-%i"' % (stamps['epoch'][0], kind, version), modified
+
+    def compact_journal(self, workspace, keep=None):
+        """
+        Removes all but the last ``keep`` (default ``journal_size``)
+        journal entries. Returns the number of entries removed.
+        """
+        keep = self.journal_size if keep is None else int(keep)
         db = self.get_connection(workspace)
-        
-        variables = []
-        column = 'name, type, update_ts, value'
         try:
-            if variable is None:
-                c = db.execute("SELECT " + column + " FROM _grid_vars")
-            else:
-                c = db.execute("SELECT " + column + " FROM _grid_vars WHERE name=?",
-                               (variable,))
-            for row in c:
-                variables.append({
-                    "data-type": "grid/variable/entry",
-                    "name": row['name'],
-                    "type": row['type'],
-                    "update-ts": row['update_ts'],
-                    "value": row['value']
-                })
+            db.execute("BEGIN IMMEDIATE")
+            removed = Journal.compact(db, keep)
+            db.commit()
+        except OperationalError as e:
+            db.rollback()
+            raise DatabaseError("Could not compact journal", e, format_exc())
+        finally:
+            db.close()
+        self._compacted[workspace] = time.time()
+        return removed
+
+    def _compact_journal(self, workspace, db):
+        # Compacts automatically after writes, at most every compact_interval
+        now = time.time()
+        if now - self._compacted.get(workspace, 0) < self.compact_interval:
+            return
+        self._compacted[workspace] = now
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            Journal.compact(db, self.journal_size)
+            db.commit()
+        except OperationalError:
+            db.rollback()
 
+    def _fetch_views(self, workspace, view=None, models=True):
+        view = Column.validate_name(view)
+        return self._fetch_models(workspace, 'views', view, models)
+
+    def _fetch_documents(self, workspace, document=None, models=True):
+        document = Column.validate_name(document)
+        return self._fetch_models(workspace, 'docs', document, models)
+
+    def _fetch_variables(self, workspace, variable=None, prefix=None):
+        # Variables change too often to be worth caching; one is looked up
+        # by its primary key, a namespace is a range on the same index
+        variable = Column.validate_variable_name(variable)
+        prefix = Column.validate_variable_name(prefix)
+        db = self.get_connection(workspace)
+        try:
+            return list(self._load_variables(db, prefix, variable).values())
         except OperationalError as e:
             raise DatabaseError("Invalid database", e, format_exc())
         finally:
             db.close()
+
+    def _fetch_models(self, workspace, kind, name, models):
+        items = self._fetch_metadata(workspace, kind)
+        if name is not None:
+            items = {name: items[name]} if name in items else {}
+        if not models:
+            return list(items.keys())
+        # Shallow copies, callers set 'data-type' on what they get
+        return [dict(model) for model in items.values()]
+
+    def _fetch_metadata(self, workspace, kind):
+        """
+        Returns a dict of name to model for one kind of metadata
+        ('docs' or 'views') served from :attr:`metadata`.
+        """
+        def version():
+            db = self.get_connection(workspace)
+            try:
+                row = db.execute("SELECT version FROM _grid_meta WHERE name=?",
+                                 (kind,)).fetchone()
+            except OperationalError as e:
+                raise DatabaseError("Invalid database", e, format_exc())
+            finally:
+                db.close()
+            return row['version'] if row is not None else None
+
+        def load():
+            db = self.get_connection(workspace)
+            try:
+                # Read the version and the models from the same snapshot
+                db.execute("BEGIN")
+                row = db.execute("SELECT version FROM _grid_meta WHERE name=?",
+                                 (kind,)).fetchone()
+                items = self._load_models(db, METADATA_TABLES[kind])
+                db.rollback()
+            except OperationalError as e:
+                raise DatabaseError("Invalid database", e, format_exc())
+            finally:
+                db.close()
+            return (row['version'] if row is not None else None), items
+
+        return self.metadata.get((workspace, kind), version, load)
+
+    def _load_models(self, db, table):
+        models = {}
+        for row in db.execute("SELECT name, data_model FROM " + table):
+            models[row['name']] = json.loads(row['data_model'])
+        return models
+
+    def _load_variables(self, db, prefix=None, name=None):
+        sql = "SELECT name, type, update_ts, value FROM _grid_vars"
+        params = ()
+        if name:
+            sql += " WHERE name=?"
+            params = (name,)
+        elif prefix:
+            # '/' sorts right after '.', so this is every name.*
+            sql += " WHERE name=? OR (name >= ? AND name < ?)"
+            params = (prefix, prefix + '.', prefix + '/')
+        variables = {}
+        for row in db.execute(sql, params):
+            variables[row['name']] = {
+                "data-type": "grid/variable/entry",
+                "name": row['name'],
+                "type": row['type'],
+                "update-ts": row['update_ts'],
+                "value": row['value']
+            }
         return variables
 
 
+class ConnectionPool(object):
+    """
+    Keeps long-lived connections to one workspace database. Connections
+    are handed out as :class:`PooledConnection` and go back to the pool
+    when closed. An idle connection last used by the borrowing thread is
+    preferred, idle connections are health checked before reuse and
+    evicted after ``idle_timeout`` seconds. At most ``size`` connections
+    are open at once; further borrowers wait up to ``wait_timeout``.
+
+    New connections get the ``pragmas`` (see :data:`PRAGMAS`). In WAL mode
+    a passive checkpoint is run on release at most every
+    ``checkpoint_interval`` seconds. ``setup`` is called with every new
+    connection.
+    """
+    pragma_value = re.compile(r'^-?[A-Za-z0-9_]+$')
+
+    def __init__(self, path, size=8, idle_timeout=300.0, wait_timeout=30.0,
+                 pragmas=None, checkpoint_interval=300.0, setup=None):
+        self.path = path
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.pragmas = self.validate_pragmas(pragmas)
+        self.checkpoint_interval = checkpoint_interval
+        self.setup = setup
+        self._idle = []  # [(thread ident, released at, sqlite3.Connection)]
+        self._open = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._checkpointed = time.time()
+        self._checkpointing = False
+
+    def acquire(self):
+        thread = threading.current_thread().ident
+        deadline = time.time() + self.wait_timeout
+        while True:
+            with self._condition:
+                stale = self._evict()
+                db = self._take(thread)
+                while db is None and self._open >= self.size:
+                    remaining = deadline - time.time()
+                    if self._closed or remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                    stale += self._evict()
+                    db = self._take(thread)
+                if self._closed:
+                    raise DatabaseError("Connection pool closed")
+                if db is None and self._open >= self.size:
+                    raise DatabaseError("Connection pool exhausted")
+                if db is None:
+                    self._open += 1
+
+            for old in stale:
+                old.close()
+
+            if db is None:
+                try:
+                    db = self.connect()
+                except Exception:
+                    self._discard()
+                    raise
+            elif not self._healthy(db):
+                db.close()
+                self._discard()
+                continue
+            return PooledConnection(self, db)
+
+    def release(self, db):
+        try:
+            if db.in_transaction:
+                db.rollback()
+            self._checkpoint(db)
+        except sqlite3.Error:
+            db.close()
+            self._discard()
+            return
+
+        thread = threading.current_thread().ident
+        with self._condition:
+            if self._closed:
+                self._open -= 1
+                db.close()
+            else:
+                self._idle.append((thread, time.time(), db))
+            self._condition.notify()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False,
+                             cached_statements=256)
+        db.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            db.execute("PRAGMA %s=%s" % (name, value)).fetchall()
+        if self.setup is not None:
+            self.setup(db)
+        return db
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._condition.notify_all()
+        for _, _, db in idle:
+            db.close()
+
+    def _take(self, thread):
+        # Prefer the most recently released connection of this thread
+        for n in range(len(self._idle) - 1, -1, -1):
+            if self._idle[n][0] == thread:
+                return self._idle.pop(n)[2]
+        if self._idle:
+            return self._idle.pop()[2]
+
+    def _evict(self):
+        limit = time.time() - self.idle_timeout
+        stale = [db for _, released, db in self._idle if released < limit]
+        if stale:
+            self._idle = [entry for entry in self._idle if entry[1] >= limit]
+            self._open -= len(stale)
+        return stale
+
+    def _discard(self):
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    def _checkpoint(self, db):
+        if str(self.pragmas.get('journal_mode')).upper() != 'WAL':
+            return
+        with self._condition:
+            if (self._checkpointing or
+                    time.time() - self._checkpointed < self.checkpoint_interval):
+                return
+            self._checkpointing = True
+        try:
+            db.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+        finally:
+            with self._condition:
+                self._checkpointing = False
+                self._checkpointed = time.time()
+
+    @classmethod
+    def validate_pragmas(cls, pragmas):
+        result = dict(PRAGMAS)
+        for name, value in (pragmas or {}).items():
+            if name not in PRAGMAS:
+                raise ValueError("Unsupported pragma " + str(name))
+            if value is None:
+                continue
+            if not cls.pragma_value.match(str(value)):
+                raise ValueError("Bad value for pragma " + name)
+            result[name] = value
+        return result
+
+    def _healthy(self, db):
+        try:
+            db.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+
+class PooledConnection(object):
+    """
+    Wraps a :class:`sqlite3.Connection` borrowed from a
+    :class:`ConnectionPool`. Closing it hands the connection back to the
+    pool, rolling back anything left uncommitted.
+    """
+    def __init__(self, pool, db):
+        self._pool = pool
+        self._db = db
+
+    def __getattr__(self, name):
+        if self._db is None:
+            raise DatabaseError("Connection already closed")
+        return getattr(self._db, name)
+
+    def close(self):
+        db, self._db = self._db, None
+        if db is not None:
+            self._pool.release(db)
+
+
 class Column(object):
     cleaner = re.compile(r'[^A-Za-z0-9_]+')
     variable_cleaner = re.compile(r'[^A-Za-z0-9_\.]+')
@@ -518,6 +1377,358 @@ class Table(object):
             if column.primary_key:
                 return column.name
 
+
+class Index(object):
+    """
+    A secondary (possibly composite) index on a document, kept in the
+    *indexes* list of the document's data model. A leading ``-`` on a
+    column name makes that part of the index descending.
+    """
+    def __init__(self, data, table):
+        self.name = Column.validate_name(data.get('name'))
+        self.unique = Column.validate_bool(data.get('unique', False))
+        self.columns = []
+
+        assert self.name is not None
+        names = set(column.name for column in table.columns)
+        for name in data.get('columns') or []:
+            if Column.validate_name(name.lstrip('-')) not in names:
+                raise ValueError("No such column: " + name)
+            self.columns.append(name)
+        assert len(self.columns) > 0
+
+    @classmethod
+    def sql_name(cls, document, name):
+        return document + '__' + name
+
+    def sql(self, document):
+        parts = [name[1:] + ' DESC' if name.startswith('-') else name
+                 for name in self.columns]
+        return ("CREATE " + ("UNIQUE " if self.unique else "") + "INDEX " +
+                self.sql_name(document, self.name) + " ON " + document +
+                " (" + ', '.join(parts) + ")")
+
+    def to_dict(self):
+        return {
+            'data-type': 'grid/index/entry',
+            'name': self.name,
+            'columns': self.columns,
+            'unique': self.unique,
+        }
+
+
+class Aggregation(object):
+    """
+    Aggregate functions over a document, optionally grouped and filtered,
+    checked against the document's :class:`Table`. The dict form is::
+
+        {
+            "aggregates": [
+                {"function": "count"},
+                {"function": "sum", "column": "price", "name": "revenue"}
+            ],
+            "group-by": ["kind"],
+            "where": {"price": {">": 0}}
+        }
+
+    *where* is the same as for :class:`Query`. Results are ordered by the
+    group columns. An aggregate is named *function_column* (or *count*)
+    unless given a *name*.
+    """
+    functions = ('count', 'sum', 'min', 'max', 'avg')
+
+    def __init__(self, data, table):
+        self.aggregates = []  # [(function, column, name)]
+        self.group_by = []
+        self.query = Query({'where': data.get('where')}, table)
+
+        names = set(column.name for column in table.columns)
+        for name in data.get('group-by') or []:
+            if name not in names:
+                raise ValueError("No such column: " + str(name))
+            self.group_by.append(name)
+
+        for aggregate in data.get('aggregates') or []:
+            function = str(aggregate.get('function', '')).lower()
+            column = aggregate.get('column', '*')
+            if function not in self.functions:
+                raise ValueError("Unsupported function " + function)
+            if column == '*':
+                if function != 'count':
+                    raise ValueError("Only count can take *")
+            elif column not in names:
+                raise ValueError("No such column: " + str(column))
+            name = Column.validate_name(aggregate.get('name') or (
+                function if column == '*' else function + '_' + column))
+            self.aggregates.append((function, column, name))
+
+        if not self.aggregates:
+            raise ValueError("No aggregates given")
+        if len(set(self.names())) != len(self.names()):
+            raise ValueError("Aggregate names must be unique")
+
+    def names(self):
+        return self.group_by + [name for _, _, name in self.aggregates]
+
+    def sql(self, document):
+        select = list(self.group_by)
+        select += ["%s(%s) AS %s" % (function.upper(), column, name)
+                   for function, column, name in self.aggregates]
+        where, params = self.query.where_sql()
+
+        sql = "SELECT " + ", ".join(select) + " FROM " + document
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if self.group_by:
+            sql += " GROUP BY " + ", ".join(self.group_by)
+            sql += " ORDER BY " + ", ".join(self.group_by)
+        return sql, params
+
+
+class PageCursor(object):
+    """
+    Opaque paging cursor handed out as *next-cursor* in data feeds. It
+    holds the sort values of the last row delivered and the number of
+    rows delivered so far.
+    """
+    @classmethod
+    def encode(cls, values, position):
+        data = json.dumps([values, position]).encode('utf8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    @classmethod
+    def decode(cls, cursor):
+        try:
+            values, position = json.loads(
+                base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+            if not isinstance(values, list) or not all(
+                    isinstance(value, Query.scalars) for value in values):
+                raise ValueError()
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+        return values, int(position)
+
+
+class Query(object):
+    """
+    Filtering, sorting and projection of the rows of a document, checked
+    against the document's :class:`Table`. The dict form is::
+
+        {
+            "columns": ["name", "price"],
+            "where": {
+                "kind": "fruit",
+                "price": {">=": 10, "<": 20},
+                "origin": {"in": ["SE", "NO"]}
+            },
+            "order-by": ["-price", "name"]
+        }
+
+    A plain value in *where* means equality (``None`` matches NULL),
+    a leading ``-`` in *order-by* sorts descending.
+    """
+    operators = {
+        '=': '=',
+        '!=': '!=',
+        '<': '<',
+        '<=': '<=',
+        '>': '>',
+        '>=': '>=',
+        'in': 'IN',
+    }
+
+    def __init__(self, data=None, table=None):
+        self.columns = None  # Projection, None for all columns
+        self.where = []  # [(column, operator, value)]
+        self.order_by = []  # [(column, descending)]
+
+        if data:
+            self.use(data, table)
+
+    # What SQLite takes as a parameter; JSON gives no bytes
+    scalars = (str, int, float, type(None))
+
+    def use(self, data, table):
+        names = set(column.name for column in table.columns)
+
+        def check(name):
+            if not isinstance(name, str) or name not in names:
+                raise ValueError("No such column: " + str(name))
+            return name
+
+        columns = data.get('columns')
+        if columns:
+            if not isinstance(columns, list):
+                raise ValueError("columns must be a list")
+            self.columns = [check(name) for name in columns]
+
+        where = data.get('where') or {}
+        if not isinstance(where, dict):
+            raise ValueError("where must be an object")
+        for name, condition in where.items():
+            check(name)
+            if not isinstance(condition, dict):
+                condition = {'=': condition}
+            for operator, value in condition.items():
+                if operator not in self.operators:
+                    raise ValueError("Unsupported operator " + str(operator))
+                if operator == 'in':
+                    if not isinstance(value, list) or not all(
+                            isinstance(item, self.scalars) for item in value):
+                        raise ValueError("Operator in takes a list of values")
+                elif not isinstance(value, self.scalars):
+                    raise ValueError("Operator %s takes a value" % operator)
+                self.where.append((name, operator, value))
+
+        order_by = data.get('order-by') or []
+        if not isinstance(order_by, list):
+            raise ValueError("order-by must be a list")
+        for name in order_by:
+            if not isinstance(name, str):
+                raise ValueError("No such column: " + str(name))
+            descending = name.startswith('-')
+            self.order_by.append((check(name.lstrip('-')), descending))
+
+    def where_sql(self):
+        """
+        Returns a list of SQL conditions (to be joined with AND) and a list
+        of parameters for them.
+        """
+        conditions = []
+        params = []
+        for name, operator, value in self.where:
+            if operator == 'in':
+                if not value:
+                    conditions.append("0")
+                    continue
+                conditions.append("%s IN (%s)" % (name, ', '.join(['?'] * len(value))))
+                params += value
+            elif value is None and operator in ('=', '!='):
+                conditions.append(name + (" IS NULL" if operator == '=' else " IS NOT NULL"))
+            else:
+                conditions.append("%s %s ?" % (name, self.operators[operator]))
+                params.append(value)
+        return conditions, params
+
+    @classmethod
+    def after_sql(cls, order, values):
+        """
+        Returns an SQL condition (and its parameters) matching the rows
+        that come after a row with the sort ``values`` in ``order``, a list
+        of ``(column, descending)``. NULLs sort first, like in SQLite.
+        """
+        alternatives = []
+        params = []
+        for n, (column, descending) in enumerate(order):
+            parts = []
+            part_params = []
+            for tie_column, _ in order[:n]:
+                parts.append(tie_column + " IS ?")
+            part_params += values[:n]
+
+            value = values[n]
+            if value is None:
+                if descending:
+                    continue  # Nothing comes after NULL when descending
+                parts.append(column + " IS NOT NULL")
+            elif descending:
+                parts.append("(%s < ? OR %s IS NULL)" % (column, column))
+                part_params.append(value)
+            else:
+                parts.append(column + " > ?")
+                part_params.append(value)
+
+            alternatives.append(" AND ".join(parts))
+            params += part_params
+
+        if not alternatives:
+            return "0", []
+        if len(alternatives) == 1:
+            return alternatives[0], params
+        return "(" + " OR ".join(["(%s)" % a for a in alternatives]) + ")", params
+
+
+class BulkLoader(object):
+    """
+    Turns a CSV or NDJSON text stream into chunks of parameter rows for
+    ``executemany``. Every distinct column set is validated against the
+    :class:`Table` once, and the per-column converters are set up then.
+    """
+    def __init__(self, table, format):
+        self.table = table
+        self.format = format
+        self.types = {column.name: column.type_name for column in table.columns}
+        self._plans = {}
+
+    def plan(self, columns):
+        columns = tuple(columns)
+        plan = self._plans.get(columns)
+        if plan is None:
+            converters = []
+            for column in columns:
+                type_name = self.types.get(column)
+                if type_name is None:
+                    raise ValueError("No such column: " + str(column))
+                converters.append(self.converter(type_name))
+            plan = self._plans[columns] = converters
+        return plan
+
+    def converter(self, type_name):
+        if self.format != 'csv' or type_name == 'TEXT':
+            return None
+        # CSV has no NULL, an empty field in a non-TEXT column means NULL
+        return lambda value: None if value == '' else value
+
+    def chunks(self, stream, chunk_size):
+        if self.format == 'csv':
+            records = self._csv_records(stream)
+        else:
+            records = self._ndjson_records(stream)
+
+        columns = None
+        chunk = []
+        for record_columns, values in records:
+            if record_columns != columns:
+                if chunk:
+                    yield columns, chunk
+                    chunk = []
+                columns = record_columns
+                converters = self.plan(columns)
+                convert = any(converters)
+            if convert:
+                values = [v if c is None else c(v) for c, v in zip(converters, values)]
+            chunk.append(values)
+            if len(chunk) >= chunk_size:
+                yield columns, chunk
+                chunk = []
+        if chunk:
+            yield columns, chunk
+
+    def _csv_records(self, stream):
+        reader = csv.reader(stream)
+        try:
+            columns = tuple(next(reader))
+        except StopIteration:
+            return
+        for values in reader:
+            if not values:
+                continue
+            if len(values) != len(columns):
+                raise ValueError("Expected %i fields on line %i" %
+                                 (len(columns), reader.line_num))
+            yield columns, values
+
+    def _ndjson_records(self, stream):
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("Expected one JSON object per line")
+            yield tuple(record.keys()), list(record.values())
+
+
 class Instruction(object):
     def __init__(self, data):
         self.mode = data.get('mode', 'insert')
@@ -529,6 +1740,14 @@ class Instruction(object):
         self.status = None
         self.affected_rows = 0
 
+        if not isinstance(self.values, dict) or not isinstance(self.where, dict):
+            raise ValueError("values and where must be objects")
+        for column in list(self.values.keys()) + list(self.where.keys()):
+            Column.validate_name(column)
+        for value in list(self.values.values()) + list(self.where.values()):
+            if not isinstance(value, Query.scalars + (bytes,)):
+                raise ValueError("Column values must be scalars")
+
     def __repr__(self):
         return "<Instruction {0}>".format(self.mode)
     
@@ -561,61 +1780,115 @@ class Instruction(object):
             values.append(v)
         return columns, values
 
-    def perform(self, db, document):
-        if self.is_insert:
-            self._perform_insert(db, document)
-        elif self.is_update:
-            self._perform_update(db, document)
-        elif self.is_delete:
-            self._perform_delete(db, document)
+    def columns(self):
+        return tuple(sorted(self.values.keys()))
 
-    def _perform_insert(self, db, document):
+    @classmethod
+    def batches(cls, instructions):
+        """
+        Splits a list of instructions into runs of consecutive inserts
+        sharing the same column set. Any other instruction is a run of
+        its own.
+        """
+        batch = []
+        for instruction in instructions:
+            if batch and not (instruction.is_insert and batch[0].is_insert and
+                              instruction.columns() == batch[0].columns()):
+                yield batch
+                batch = []
+            batch.append(instruction)
+        if batch:
+            yield batch
+
+    @classmethod
+    def perform_batch(cls, db, document, instructions):
+        """
+        Performs a run from :meth:`batches` within the current transaction.
+        Runs of inserts go through ``executemany``. Should that fail, every
+        instruction is performed on its own so that only the failing ones
+        are rolled back.
+        """
+        if len(instructions) == 1 or not instructions[0].is_insert:
+            for instruction in instructions:
+                instruction.perform(db, document)
+            return
+
+        columns = instructions[0].columns()
+        db.execute("SAVEPOINT instruction")
         try:
-            columns, values = self.get_value_lists()
-            cur = db.cursor()
-            cur.execute("INSERT INTO " + document + 
-                        "(" + ', '.join(columns) + ") " +
-                        "VALUES (" + ', '.join(['?'] * len(values)) + ")",
-                        values)
-            self.affected_rows = cur.rowcount
-            db.commit()
-            self.status = True
-        finally:
-            self.status = False if self.status is None else self.status
+            db.executemany(cls.insert_sql(document, columns),
+                           [[i.values[c] for c in columns]
+                            for i in instructions])
+            db.execute("RELEASE instruction")
+        except sqlite3.Error:
+            db.execute("ROLLBACK TO instruction")
+            db.execute("RELEASE instruction")
+            for instruction in instructions:
+                instruction.perform(db, document)
+            return
 
-    def _perform_update(self, db, document):
+        for instruction in instructions:
+            instruction.affected_rows = 1
+            instruction.status = True
+
+    @classmethod
+    def insert_sql(cls, document, columns):
+        if not columns:
+            return "INSERT INTO " + document + " DEFAULT VALUES"
+        return ("INSERT INTO " + document + 
+                " (" + ', '.join(columns) + ") " +
+                "VALUES (" + ', '.join(['?'] * len(columns)) + ")")
+
+    def where_sql(self):
+        where_columns, where_values = self.get_where_lists()
+        if not where_columns:
+            return "", []
+        return (" WHERE " + " AND ".join([c+"=?" for c in where_columns]),
+                where_values)
+
+    def perform(self, db, document):
+        """
+        Performs this instruction within the current transaction, isolated
+        by a savepoint. A failing instruction is rolled back and gets
+        ``status`` set to ``False``.
+        """
+        if not (self.is_insert or self.is_update or self.is_delete):
+            return
+
+        db.execute("SAVEPOINT instruction")
         try:
-            columns, values = self.get_value_lists()
-            where_columns, where_values = self.get_where_lists()
-            cur = db.cursor()
-            cur.execute("UPDATE " + document + 
-                        " SET " + ", ".join([c+"=?" for c in columns]) +
-                        (
-                            (" WHERE " + ", ".join([c+"=?" for c in where_columns])
-                             if len(where_columns) else "")
-                        )
-                        , values + where_values)
-            self.affected_rows = cur.rowcount
-            db.commit()
+            if self.is_insert:
+                self._perform_insert(db, document)
+            elif self.is_update:
+                self._perform_update(db, document)
+            elif self.is_delete:
+                self._perform_delete(db, document)
+            db.execute("RELEASE instruction")
             self.status = True
-        finally:
-            self.status = False if self.status is None else self.status
+        except sqlite3.Error:
+            db.execute("ROLLBACK TO instruction")
+            db.execute("RELEASE instruction")
+            self.affected_rows = 0
+            self.status = False
+
+    def _perform_insert(self, db, document):
+        columns = self.columns()
+        cur = db.execute(self.insert_sql(document, columns),
+                         [self.values[c] for c in columns])
+        self.affected_rows = cur.rowcount
+
+    def _perform_update(self, db, document):
+        columns, values = self.get_value_lists()
+        where, where_values = self.where_sql()
+        cur = db.execute("UPDATE " + document + 
+                         " SET " + ", ".join([c+"=?" for c in columns]) +
+                         where, values + where_values)
+        self.affected_rows = cur.rowcount
 
     def _perform_delete(self, db, document):
-        try:
-            where_columns, where_values = self.get_where_lists()
-            cur = db.cursor()
-            cur.execute("DELETE FROM " + document + 
-                        (
-                            (" WHERE " + ", ".join([c+"=?" for c in where_columns])
-                             if len(where_columns) else "")
-                        )
-                        , where_values)
-            self.affected_rows = cur.rowcount
-            db.commit()
-            self.status = True
-        finally:
-            self.status = False if self.status is None else self.status
+        where, where_values = self.where_sql()
+        cur = db.execute("DELETE FROM " + document + where, where_values)
+        self.affected_rows = cur.rowcount
 
 class DatabaseError(Exception):
     def __init__(self, message=None, exception=None, traceback=None):
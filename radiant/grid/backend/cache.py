@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import time
+import threading
+
+
+class MetadataCache(object):
+    """
+    Versioned in-process cache for workspace metadata (document and view
+    models). Each entry is stored together with the version
+    counter it was loaded at. Within ``ttl`` seconds of the last check an
+    entry is served as is; after that the current version is read and the
+    entry is reloaded only if it has moved. Local writes call
+    :meth:`invalidate` so they are seen immediately.
+    """
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self._entries = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version, load):
+        """
+        Returns the cached items for ``key``.
+
+        :param tuple key: Cache key, typically ``(workspace, kind)``
+        :param callable version: Returns the current version counter
+        :param callable load: Returns a ``(version, items)`` tuple read
+                              from the database
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generations.get(key, 0)
+
+        if entry is not None:
+            if now - entry.checked < self.ttl:
+                return entry.items
+            if version() == entry.version:
+                entry.checked = now
+                return entry.items
+
+        loaded_version, items = load()
+        with self._lock:
+            # Don't store what was loaded if it got invalidated meanwhile
+            if self._generations.get(key, 0) == generation:
+                self._entries[key] = CacheEntry(loaded_version, now, items)
+        return items
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def expire(self, key, version):
+        """
+        Drops the entry for ``key`` unless it was loaded at ``version``, so
+        that the next :meth:`get` is no older than that version.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version != version:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries.keys()):
+                self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.clear()
+
+
+class CacheEntry(object):
+    __slots__ = ('version', 'checked', 'items')
+
+    def __init__(self, version, checked, items):
+        self.version = version
+        self.checked = checked
+        self.items = items
@@ -8,9 +8,14 @@ The *Definition* module contains object wrappers of the various
 - :class:`ItemDefinition`
 - :class:`DocumentDefinition`
 - :class:`ColumnDefinition`
+- :class:`IndexDefinition`
 - :class:`VariableDefinition`
 - :class:`DataDefinition`
+- :class:`DataPage`
+- :class:`DataRow`
+- :class:`ChangeDefinition`
 - :class:`Feed`
+- :class:`ChangeFeed`
 
 .. note::
     
@@ -20,8 +25,45 @@ The *Definition* module contains object wrappers of the various
     serializing to JSON.
 """
 
+import sys
+import json
+from array import array
+from collections.abc import Mapping
 
-class ViewDefinition(object):
+
+class Definition(object):
+    """
+    Base of the definition classes, with the JSON shortcuts. Definitions
+    have ``__slots__``, so they take no more memory than their fields.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def load(cls, d):
+        """
+        Creates an instance from a dict, taking over what the dict holds
+        instead of copying it where the class would otherwise copy. Used
+        for the entries of a :class:`Feed`.
+        """
+        definition = cls.__new__(cls)
+        definition.from_dict(d)
+        return definition
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Creates an instance from JSON (:class:`bytes` or :class:`str`).
+        """
+        return cls.load(json.loads(data))
+
+    def to_json(self):
+        """
+        Returns the JSON encoding of :meth:`to_dict` as :class:`bytes`.
+        """
+        return json.dumps(self.to_dict()).encode('utf8')
+
+
+class ViewDefinition(Definition):
     """
     Defines a View within a Workspace. A View describes a graphical representation
     of the data in the Workspace using *items*. Items have various properties
@@ -30,6 +72,8 @@ class ViewDefinition(object):
     :cvar str name: [*name*] Workspace-unique name of this View
     :cvar list items: [*items*] List of :class:`ItemDefinition`
     """
+    __slots__ = ('name', 'items')
+
     data_type = "grid/view/entry"
     """ [*data-type*] """
 
@@ -57,7 +101,7 @@ class ViewDefinition(object):
         self.items = {item.name: item for item in items}
         
 
-class ItemDefinition(object):
+class ItemDefinition(Definition):
     """
     Defines a graphical *Item* in a *View* (:class:`ViewDefinition`). The ``item_type`` can be one of:
 
@@ -70,6 +114,8 @@ class ItemDefinition(object):
     :cvar list position: [*position*] Two or four values describing the position, either as 
                          (x, y) or (x1, y1, x2, y2) depending on item type
     """
+    __slots__ = ('item_type', 'name', 'properties', 'position')
+
     data_type = "grid/item/entry"
     """ [*data-type*] """
 
@@ -103,7 +149,7 @@ class ItemDefinition(object):
         self.position = d['position']
 
 
-class DocumentDefinition(object):
+class DocumentDefinition(Definition):
     """
     Defines a Document within a Workspace. A Document describes a
     table in a database that can hold data. The columns are defined
@@ -111,7 +157,10 @@ class DocumentDefinition(object):
 
     :cvar str name: [*name*] Workspace-unique name of this View
     :cvar dict columns: [*columns*] List of :class:`ColumnDefinition`
+    :cvar dict indexes: [*indexes*] List of :class:`IndexDefinition`
     """
+    __slots__ = ('name', 'columns', 'indexes')
+
     data_type = "grid/document/entry"
     """ [*data-type*] """
 
@@ -123,13 +172,15 @@ class DocumentDefinition(object):
         """
         self.name = None
         self.columns = {}
+        self.indexes = {}
         if d: self.from_dict(d)
 
     def to_dict(self):
         return {
             "data-type": self.data_type,
             "name": self.name,
-            "columns": [column.to_dict() for column in self.columns.values()]
+            "columns": [column.to_dict() for column in self.columns.values()],
+            "indexes": [index.to_dict() for index in self.indexes.values()]
         }
 
     def from_dict(self, d):
@@ -137,8 +188,10 @@ class DocumentDefinition(object):
         self.name = d["name"]
         columns = [ColumnDefinition(column) for column in d.get("columns", [])]
         self.columns = {column.name: column for column in columns}
+        indexes = [IndexDefinition(index) for index in d.get("indexes", [])]
+        self.indexes = {index.name: index for index in indexes}
 
-class ColumnDefinition(object):
+class ColumnDefinition(Definition):
     """
     Defines a Column within a Document. The properties of the
     ColumnDefinition are meant to describe a database column.
@@ -151,6 +204,9 @@ class ColumnDefinition(object):
     :cvar bool auto_increment: [*auto-increment*] Column is the *auto incrementing* (default ``False``)
     :cvar bool unique: [*unique*] Column has a *unique constraint* (default ``False``)
     """
+    __slots__ = ('name', 'type_name', 'type_size', 'primary_key', 'default',
+                 'auto_increment', 'unique')
+
     data_type = "grid/column/entry"
     """ [*data-type*] """
 
@@ -193,7 +249,49 @@ class ColumnDefinition(object):
         self.unique = d.get('unique', False)
 
 
-class VariableDefinition(object):
+class IndexDefinition(Definition):
+    """
+    Defines a secondary Index on a Document. Indexes speed up filtering,
+    sorting and the *where* part of update and delete instructions.
+
+    :cvar str name: [*name*] Document-unique name of this Index
+    :cvar list columns: [*columns*] Names of the indexed columns, a leading ``-``
+                        makes that column descending
+    :cvar bool unique: [*unique*] Index has a *unique constraint* (default ``False``)
+    """
+    __slots__ = ('name', 'columns', 'unique')
+
+    data_type = "grid/index/entry"
+    """ [*data-type*] """
+
+    def __init__(self, d=None):
+        """
+        Constructor.
+
+        :param dict d: Optional dictionary to import
+        """
+        self.name = None
+        self.columns = []
+        self.unique = False
+
+        if d: self.from_dict(d)
+
+    def to_dict(self):
+        return {
+            "data-type": self.data_type,
+            "name": self.name,
+            "columns": self.columns,
+            "unique": self.unique
+        }
+
+    def from_dict(self, d):
+        assert d.get('data-type') == self.data_type
+        self.name = d['name']
+        self.columns = d.get('columns', [])
+        self.unique = d.get('unique', False)
+
+
+class VariableDefinition(Definition):
     """
     Defines a Variable within a Workspace. Variables typically 
     have dot-separated names.
@@ -203,6 +301,8 @@ class VariableDefinition(object):
                     :class:`float`, :class:`bool`)
     :cvar str value: [*value*] The value of the Variable
     """
+    __slots__ = ('name', 'type', 'value')
+
     data_type = "grid/variable/entry"
     """ [*data-type*] """
 
@@ -233,12 +333,14 @@ class VariableDefinition(object):
         self.value = d.get('value')
 
 
-class DataDefinition(object):
+class DataDefinition(Definition):
     """
     Defines a Row of Data within a Document. 
 
     :cvar dict data: [*data*] A dict with the values of the columns
     """
+    __slots__ = ('data',)
+
     data_type = "grid/data/entry"
     """ [*data-type*] """
 
@@ -261,6 +363,332 @@ class DataDefinition(object):
     def from_dict(self, d):
         self.data = dict(d)
 
+    @classmethod
+    def load(cls, d):
+        entry = cls.__new__(cls)
+        entry.data = d
+        return entry
+
+    @classmethod
+    def from_columns(cls, names, values):
+        """
+        Returns a list of DataDefinitions from a feed in the *columns*
+        layout: the column names and one list of values per column.
+        """
+        load = cls.load
+        return [load(dict(zip(names, row))) for row in zip(*values)]
+
+
+class DataPage(object):
+    """
+    A page of rows of a Document (a *grid/data/feed*) stored by column
+    rather than as one :class:`DataDefinition` per row. ``INTEGER`` and
+    ``REAL`` columns are kept in typed arrays (with the rows holding
+    ``NULL`` noted aside), other columns in one list each. The column
+    types come from the Document's :class:`ColumnDefinition` objects, or
+    are guessed from the values when those aren't given.
+
+    A DataPage is a sequence of :class:`DataRow` views, made when asked
+    for. Slicing it gives another DataPage sharing the same storage.
+
+    :cvar str workspace: [*workspace*] The workspace of this page's origin
+    :cvar int start: [*start*] Index of the first row in the Document
+    :cvar int page_size: [*page-size*] Paging page size
+    :cvar str next_cursor: [*next-cursor*] Opaque cursor for the next page,
+                           ``None`` on the last page
+    :cvar int total: [*total*] Total number of rows, if asked for (else ``None``)
+    :cvar list names: [*columns*] Names of the columns
+    :cvar array row_ids: [*row-ids*] Rowids of the rows, if the feed had them
+                         (else ``None``), see :meth:`row_id`
+    """
+    __slots__ = ('workspace', 'start', 'page_size', 'next_cursor', 'total',
+                 'names', 'row_ids', '_values', '_nulls', '_offset', '_length')
+
+    data_type = "grid/data/feed"
+    """ [*data-type*] """
+
+    typecodes = {'INTEGER': 'q', 'REAL': 'd'}
+
+    def __init__(self, d=None, columns=None):
+        """
+        Constructor.
+
+        :param dict d: Optional *grid/data/feed* to import, in either layout
+        :param columns: Optional :class:`ColumnDefinition` objects (a list,
+                        or a dict by name) giving the column types
+        """
+        self.workspace = None
+        self.start = 0
+        self.page_size = 0
+        self.next_cursor = None
+        self.total = None
+        self.names = []
+        self.row_ids = None
+        self._values = {}
+        self._nulls = {}
+        self._offset = 0
+        self._length = 0
+
+        if d: self.from_dict(d, columns)
+
+    @property
+    def count(self):
+        return self._length
+
+    @property
+    def entries(self):
+        """ The rows, for code written for a :class:`Feed` """
+        return self
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for index in range(self._offset, self._offset + self._length):
+            yield DataRow(self, index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step != 1:
+                raise ValueError("DataPage slices can't have a step")
+            page = DataPage()
+            page.workspace = self.workspace
+            page.start = self.start + start
+            page.page_size = self.page_size
+            page.total = self.total
+            page.names = self.names
+            page.row_ids = self.row_ids
+            page._values = self._values
+            page._nulls = self._nulls
+            page._offset = self._offset + start
+            page._length = max(0, stop - start)
+            return page
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError("DataPage index out of range")
+        return DataRow(self, self._offset + key)
+
+    def value(self, name, index):
+        """
+        Returns the value of column ``name`` in row ``index`` of the page.
+        """
+        return self._get(name, self._offset + index)
+
+    def row_id(self, index):
+        """
+        Returns the rowid of row ``index`` of the page, or ``None`` if the
+        page has no rowids.
+        """
+        if self.row_ids is None:
+            return None
+        return self.row_ids[self._offset + index]
+
+    def nbytes(self):
+        """
+        Returns the approximate number of bytes held by the storage of the
+        page (shared with its slices).
+        """
+        size = 0
+        for values in self._values.values():
+            if isinstance(values, array):
+                size += values.itemsize * len(values)
+            else:
+                size += 8 * len(values) + sum(map(sys.getsizeof, values))
+        if self.row_ids is not None:
+            size += self.row_ids.itemsize * len(self.row_ids)
+        return size
+
+    def _get(self, name, position):
+        nulls = self._nulls.get(name)
+        if nulls is not None and position in nulls:
+            return None
+        return self._values[name][position]
+
+    def column(self, name):
+        """
+        Returns the values of column ``name`` in the page. Typed columns
+        without ``NULL`` are returned as a :class:`memoryview` of the
+        storage; others as a list.
+        """
+        values = self._values[name]
+        stop = self._offset + self._length
+        if isinstance(values, array) and not self._nulls.get(name):
+            return memoryview(values)[self._offset:stop]
+        return [self._get(name, position)
+                for position in range(self._offset, stop)]
+
+    def to_dict(self):
+        return {
+            "data-type": self.data_type,
+            "workspace": self.workspace,
+            "start": self.start,
+            "count": self._length,
+            "page-size": self.page_size,
+            "next-cursor": self.next_cursor,
+            "total": self.total,
+            "entries": [row.data for row in self]
+        }
+
+    def from_dict(self, d, columns=None):
+        assert d.get('data-type') == self.data_type
+        self.workspace = d.get('workspace')
+        self.start = d.get('start', 0)
+        self.page_size = d.get('page-size', 0)
+        self.next_cursor = d.get('next-cursor')
+        self.total = d.get('total')
+
+        if d.get('layout') == 'columns':
+            names = d['columns']
+            values = d['values']
+        else:
+            entries = d.get('entries', [])
+            names = list(entries[0].keys()) if entries else []
+            values = [[entry[name] for entry in entries] for name in names]
+
+        if isinstance(columns, dict):
+            columns = columns.values()
+        types = {column.name: column.type_name for column in columns or ()}
+
+        self.names = list(names)
+        self.row_ids = None
+        if d.get('row-ids') is not None:
+            self.row_ids = array('q', d['row-ids'])
+        self._values = {}
+        self._nulls = {}
+        self._offset = 0
+        self._length = len(values[0]) if values else 0
+        for name, column in zip(names, values):
+            self._values[name], nulls = self._store(column, types.get(name))
+            if nulls:
+                self._nulls[name] = nulls
+
+    @classmethod
+    def from_json(cls, data, columns=None):
+        """
+        Creates a DataPage from JSON (:class:`bytes` or :class:`str`).
+        """
+        return cls(json.loads(data), columns)
+
+    def to_json(self):
+        """
+        Returns the JSON encoding of :meth:`to_dict` as :class:`bytes`.
+        """
+        return json.dumps(self.to_dict()).encode('utf8')
+
+    def _store(self, values, type_name):
+        if type_name is not None:
+            typecode = self.typecodes.get(type_name.upper())
+        else:
+            sample = next((value for value in values if value is not None), None)
+            typecode = {int: 'q', float: 'd'}.get(type(sample))
+        if typecode is None:
+            return values, None
+
+        nulls = [index for index, value in enumerate(values) if value is None]
+        try:
+            if nulls:
+                return array(typecode, [0 if value is None else value
+                                        for value in values]), set(nulls)
+            return array(typecode, values), None
+        except (TypeError, OverflowError):
+            # SQLite may hold anything in any column
+            return values, None
+
+
+class DataRow(Mapping):
+    """
+    Read-only view of one row of a :class:`DataPage`, a mapping of column
+    name to value that also offers the :class:`DataDefinition` interface.
+    """
+    __slots__ = ('_page', '_position')
+
+    data_type = DataDefinition.data_type
+
+    def __init__(self, page, position):
+        self._page = page
+        self._position = position
+
+    def __getitem__(self, name):
+        if name not in self._page._values:
+            raise KeyError(name)
+        return self._page._get(name, self._position)
+
+    def __iter__(self):
+        return iter(self._page.names)
+
+    def __len__(self):
+        return len(self._page.names)
+
+    @property
+    def data(self):
+        return {name: self._page._get(name, self._position)
+                for name in self._page.names}
+
+    def to_dict(self):
+        return {
+            "data-type": self.data_type,
+            "data": self.data
+        }
+
+
+class ChangeDefinition(Definition):
+    """
+    Defines a journaled change within a Workspace, see :class:`ChangeFeed`.
+
+    :cvar int seq: [*seq*] Workspace-unique, increasing sequence number
+    :cvar int ts: [*ts*] Time of the change (seconds since the epoch)
+    :cvar str kind: [*kind*] What changed: ``data`` (a row of a Document),
+                    ``variable`` or ``document``
+    :cvar str name: [*name*] Name of the Document or Variable
+    :cvar str mode: [*mode*] ``insert``, ``update`` or ``delete``
+    :cvar int row_id: [*row-id*] Row id of the changed row (``data`` only)
+    :cvar dict data: [*data*] The new values, ``None`` for deletes
+    """
+    __slots__ = ('seq', 'ts', 'kind', 'name', 'mode', 'row_id', 'data')
+
+    data_type = "grid/change/entry"
+    """ [*data-type*] """
+
+    def __init__(self, d=None):
+        """
+        Constructor.
+
+        :param dict d: Optional dictionary to import
+        """
+        self.seq = 0
+        self.ts = None
+        self.kind = None
+        self.name = None
+        self.mode = None
+        self.row_id = None
+        self.data = None
+
+        if d: self.from_dict(d)
+
+    def to_dict(self):
+        return {
+            "data-type": self.data_type,
+            "seq": self.seq,
+            "ts": self.ts,
+            "kind": self.kind,
+            "name": self.name,
+            "mode": self.mode,
+            "row-id": self.row_id,
+            "data": self.data
+        }
+
+    def from_dict(self, d):
+        assert d.get('data-type') == self.data_type
+        self.seq = d['seq']
+        self.ts = d.get('ts')
+        self.kind = d['kind']
+        self.name = d['name']
+        self.mode = d['mode']
+        self.row_id = d.get('row-id')
+        self.data = d.get('data')
+
 
 class Feed(object):
     """
@@ -272,8 +700,19 @@ class Feed(object):
     :cvar int start: [*start*] Paging start index
     :cvar int count: [*start*] Paging total count
     :cvar int page_size: [*page-size*] Paging page size
+    :cvar str next_cursor: [*next-cursor*] Opaque cursor for the next page,
+                           ``None`` on the last page
+    :cvar int total: [*total*] Total number of entries, if asked for (else ``None``)
     :cvar list entries: [*entries*] Entry of type ``entry_class``
+
+    A feed in the *columns* layout (see :meth:`GridBackend.get_rows`) is
+    read into entries as well, if ``entry_class`` has ``from_columns``.
+    The entries take over the dicts they are read from (see
+    :meth:`Definition.load`).
     """
+    __slots__ = ('entry_class', 'data_type', 'workspace', 'start', 'count',
+                 'page_size', 'next_cursor', 'total', 'entries')
+
     def __init__(self, entry_class, d=None, data_type=None):
         """
         Constructor.
@@ -288,6 +727,8 @@ class Feed(object):
         self.start = 0
         self.count = 0
         self.page_size = 0
+        self.next_cursor = None
+        self.total = None
         self.entries = []
 
         if d: self.from_dict(d)
@@ -299,6 +740,8 @@ class Feed(object):
             "start": self.start,
             "count": self.count,
             "page-size": self.page_size,
+            "next-cursor": self.next_cursor,
+            "total": self.total,
             "entries": [entry.to_dict() for entry in self.entries]
         }
 
@@ -308,4 +751,72 @@ class Feed(object):
         self.start = d.get('start', 0)
         self.count = d.get('count', 0)
         self.page_size = d.get('page-size', 0)
-        self.entries = [self.entry_class(entry) for entry in d.get('entries', [])]
+        self.next_cursor = d.get('next-cursor')
+        self.total = d.get('total')
+        if d.get('layout') == 'columns':
+            self.entries = self.entry_class.from_columns(d['columns'], d['values'])
+        else:
+            load = getattr(self.entry_class, 'load', self.entry_class)
+            self.entries = [load(entry) for entry in d.get('entries', [])]
+
+    @classmethod
+    def from_json(cls, entry_class, data, data_type=None):
+        """
+        Creates a Feed from JSON (:class:`bytes` or :class:`str`).
+        """
+        return cls(entry_class, json.loads(data), data_type)
+
+    def to_json(self):
+        """
+        Returns the JSON encoding of :meth:`to_dict` as :class:`bytes`.
+        """
+        return json.dumps(self.to_dict()).encode('utf8')
+
+
+class ChangeFeed(Feed):
+    """
+    Defines a Feed of :class:`ChangeDefinition` entries, the changes in a
+    Workspace after a given sequence number.
+
+    :cvar int since: [*since*] The changes are those after this sequence number
+    :cvar int last_seq: [*last-seq*] Sequence number to ask for changes after next time
+    :cvar bool reset: [*reset*] Changes since ``since`` are no longer known, reload everything
+    :cvar bool more: [*more*] There are more changes after ``last_seq`` already
+    """
+    __slots__ = ('since', 'last_seq', 'reset', 'more')
+
+    def __init__(self, d=None):
+        """
+        Constructor.
+
+        :param dict d: Optional dictionary to import
+        """
+        self.since = 0
+        self.last_seq = 0
+        self.reset = False
+        self.more = False
+        Feed.__init__(self, ChangeDefinition, d)
+
+    def to_dict(self):
+        d = Feed.to_dict(self)
+        d.update({
+            "since": self.since,
+            "last-seq": self.last_seq,
+            "reset": self.reset,
+            "more": self.more,
+        })
+        return d
+
+    def from_dict(self, d):
+        Feed.from_dict(self, d)
+        self.since = d.get('since', 0)
+        self.last_seq = d.get('last-seq', 0)
+        self.reset = d.get('reset', False)
+        self.more = d.get('more', False)
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Creates a ChangeFeed from JSON (:class:`bytes` or :class:`str`).
+        """
+        return cls(json.loads(data))
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import socket
+import selectors
+import threading
+from collections import OrderedDict
+
+from .backend import DatabaseError
+
+
+class ChangeHub(object):
+    """
+    Pushes journaled changes (see :meth:`GridBackend.get_changes`) to
+    subscribers. A single thread polls the journal of every workspace
+    with at least one subscriber every ``poll_interval`` seconds and
+    hands the new entries to the subscribers, so the cost of a waiting
+    subscriber is its queue and nothing else.
+
+    The same thread writes to the connections handed to it with
+    :meth:`stream` and :meth:`wait`, watching them in a selector, so
+    clients waiting for changes don't hold a request thread either.
+    """
+    def __init__(self, backend, poll_interval=0.25, batch_size=1000):
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._workspaces = {}
+        self._lock = threading.Lock()
+        self._attaching = []
+        self._wakeup = None
+        self._closed = False
+        self._thread = None
+
+    def subscribe(self, workspace, since=None, document=None, kinds=None,
+                  queue_size=1000):
+        """
+        Returns a :class:`Subscription` to the changes in ``workspace``,
+        optionally only those to one ``document`` and/or of the given
+        ``kinds`` (``data``, ``variable``, ``document``). With ``since``
+        the journal entries after that sequence number are queued first.
+        """
+        subscription = Subscription(self, workspace, document, kinds,
+                                    queue_size)
+        with self._lock:
+            if self._closed:
+                raise DatabaseError("Change hub is closed")
+            cursor = self._workspaces.get(workspace)
+            if cursor is None:
+                feed = self.backend.get_changes(workspace, 0, limit=0)
+                cursor = self._workspaces[workspace] = WorkspaceCursor(
+                    feed['last-seq'])
+            cursor.subscriptions.add(subscription)
+            subscription.last = cursor.seq
+            if self._thread is None:
+                self._wakeup = socket.socketpair()
+                self._thread = threading.Thread(
+                    target=self._run, name='grid-change-hub', daemon=True)
+                self._thread.start()
+
+        if since is not None:
+            try:
+                self._backlog(subscription, int(since), cursor.seq)
+            except:
+                self.unsubscribe(subscription)
+                raise
+        return subscription
+
+    def _backlog(self, subscription, since, upto):
+        # Everything after upto comes from the polling thread. Variable
+        # changes go to document subscribers too, so all are read
+        while since < upto:
+            feed = self.backend.get_changes(
+                subscription.workspace, since, None, self.batch_size)
+            if feed['reset']:
+                subscription.reset()
+                return
+            subscription.push([entry for entry in feed['entries']
+                               if entry['seq'] <= upto], None)
+            if not feed['more']:
+                return
+            since = feed['last-seq']
+
+    def stream(self, subscription, connection, head, heartbeat=15.0,
+               coalesce=0.1):
+        """
+        Takes over ``connection`` (a socket) to send the changes of
+        ``subscription`` as Server-Sent Events after the response
+        ``head``: a *change* event (or a *reset* event) per batch with the
+        batch's last sequence number as the event id, batches being at
+        least ``coalesce`` seconds apart, and a comment line after
+        ``heartbeat`` seconds without changes. Unsubscribes when the
+        client goes away.
+        """
+        self._attach(Stream(subscription, connection,
+                            head + b"retry: 3000\n\n", heartbeat, coalesce))
+
+    def wait(self, subscription, connection, timeout, respond):
+        """
+        Takes over ``connection`` (a socket) until ``subscription`` has
+        changes or ``timeout`` seconds have passed, then writes the bytes
+        returned by ``respond()`` to it, closes it and unsubscribes.
+        """
+        self._attach(Stream(subscription, connection, b'', timeout=timeout,
+                            respond=respond))
+
+    def _attach(self, stream):
+        with self._lock:
+            if not self._closed:
+                self._attaching.append(stream)
+                stream = None
+        if stream is not None:
+            stream.close()
+            self.unsubscribe(stream.subscription)
+            return
+        try:
+            self._wakeup[1].send(b'\0')
+        except OSError:
+            pass
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            cursor = self._workspaces.get(subscription.workspace)
+            if cursor is not None:
+                cursor.subscriptions.discard(subscription)
+                if not cursor.subscriptions:
+                    del self._workspaces[subscription.workspace]
+        subscription.close()
+
+    def close(self):
+        """
+        Stops polling and ends all subscriptions.
+        """
+        with self._lock:
+            self._closed = True
+            subscriptions = [subscription
+                             for cursor in self._workspaces.values()
+                             for subscription in cursor.subscriptions]
+            self._workspaces.clear()
+        for subscription in subscriptions:
+            subscription.close()
+        if self._thread is not None:
+            try:
+                self._wakeup[1].send(b'\0')
+            except OSError:
+                pass
+            self._thread.join()
+            for end in self._wakeup:
+                end.close()
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup[0], selectors.EVENT_READ)
+        streams = set()
+        polled = 0.0
+        try:
+            while not self._closed:
+                timeout = max(0.0, min([polled + self.poll_interval] +
+                                       [stream.due() for stream in streams]) -
+                              time.time())
+                for key, events in selector.select(timeout):
+                    if key.fileobj is self._wakeup[0]:
+                        try:
+                            self._wakeup[0].recv(4096)
+                        except OSError:
+                            pass
+                        with self._lock:
+                            attaching, self._attaching = self._attaching, []
+                        for stream in attaching:
+                            selector.register(stream.connection,
+                                              selectors.EVENT_READ, stream)
+                            streams.add(stream)
+                    elif not key.data.transfer(events):
+                        self._drop(selector, streams, key.data)
+
+                if time.time() >= polled + self.poll_interval:
+                    polled = time.time()
+                    with self._lock:
+                        workspaces = list(self._workspaces.items())
+                    for workspace, cursor in workspaces:
+                        try:
+                            self._poll(workspace, cursor)
+                        except Exception:
+                            # The workspace may be gone or busy, try again later
+                            pass
+
+                now = time.time()
+                for stream in list(streams):
+                    if not stream.update(now) or not stream.transfer(0):
+                        self._drop(selector, streams, stream)
+                    else:
+                        selector.modify(stream.connection, stream.events(),
+                                        stream)
+        finally:
+            with self._lock:
+                streams.update(self._attaching)
+                self._attaching = []
+            for stream in streams:
+                stream.finish()
+                self.unsubscribe(stream.subscription)
+            selector.close()
+
+    def _drop(self, selector, streams, stream):
+        selector.unregister(stream.connection)
+        streams.discard(stream)
+        stream.close()
+        self.unsubscribe(stream.subscription)
+
+    def _poll(self, workspace, cursor):
+        more = True
+        while more and not self._closed:
+            feed = self.backend.get_changes(workspace, cursor.seq,
+                                            limit=self.batch_size)
+            more = feed['more']
+            with self._lock:
+                for subscription in cursor.subscriptions:
+                    if feed['reset']:
+                        subscription.reset()
+                    else:
+                        subscription.push(feed['entries'], feed['last-seq'])
+                cursor.seq = feed['last-seq']
+
+
+class WorkspaceCursor(object):
+    __slots__ = ('seq', 'subscriptions')
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.subscriptions = set()
+
+
+class Stream(object):
+    """
+    A connection the hub writes to: the changes of a subscription as
+    Server-Sent Events or, with ``respond``, a single response once there
+    are changes or ``timeout`` seconds have passed.
+    """
+    def __init__(self, subscription, connection, head, heartbeat=15.0,
+                 coalesce=0.1, timeout=None, respond=None):
+        self.subscription = subscription
+        self.connection = connection
+        self.heartbeat = heartbeat
+        self.coalesce = coalesce
+        self.respond = respond
+        self.output = bytearray(head)
+        self.done = False
+        now = time.time()
+        self.written = now
+        self.changed = now - coalesce
+        self.deadline = now + timeout if timeout is not None else None
+        connection.setblocking(False)
+
+    def due(self):
+        """
+        Returns when :meth:`update` has something to do at the latest.
+        """
+        if self.output or self.done:
+            return float('inf')
+        if self.respond is not None:
+            return 0.0 if self.subscription.waiting() else self.deadline
+        if self.subscription.waiting():
+            return min(self.changed + self.coalesce, self.written + self.heartbeat)
+        return self.written + self.heartbeat
+
+    def update(self, now):
+        """
+        Queues what is due at ``now`` for writing. Returns ``False`` when
+        the connection is to be closed right away.
+        """
+        if self.output or self.done:
+            return True
+        if self.respond is not None:
+            if self.subscription.waiting() or self.subscription.closed or \
+                    now >= self.deadline:
+                try:
+                    self.output += self.respond()
+                except Exception:
+                    return False
+                self.done = True
+            return True
+
+        if self.subscription.closed:
+            return False
+        if now >= self.changed + self.coalesce:
+            feed = self.subscription.get(0)
+            if feed is not None:
+                event = 'reset' if feed['reset'] else 'change'
+                self.output += ("event: %s\nid: %i\ndata: %s\n\n" % (
+                    event, feed['last-seq'], json.dumps(feed))).encode('utf8')
+                self.changed = self.written = now
+                return True
+        if now >= self.written + self.heartbeat:
+            self.output += b": heartbeat\n\n"
+            self.written = now
+        return True
+
+    def events(self):
+        if self.output:
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    def transfer(self, events):
+        """
+        Reads what the client sent (only its going away matters) and
+        writes as much of the output as the socket takes. Returns
+        ``False`` when the connection is to be closed.
+        """
+        try:
+            if events & selectors.EVENT_READ and not self.connection.recv(4096):
+                return False
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            return False
+        try:
+            if self.output:
+                del self.output[:self.connection.send(self.output)]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            return False
+        return not (self.done and not self.output)
+
+    def finish(self):
+        # A waiting client gets its answer, even if the hub is closing
+        if self.respond is not None and not self.done:
+            try:
+                self.output += self.respond()
+            except Exception:
+                pass
+        if self.output:
+            try:
+                self.connection.send(self.output)
+            except OSError:
+                pass
+        self.close()
+
+    def close(self):
+        try:
+            self.connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self.connection.close()
+
+
+class Subscription(object):
+    """
+    The changes waiting to be sent to one subscriber. At most
+    ``queue_size`` entries are queued; later changes to the same row or
+    variable replace the queued entry, while every change to a document
+    as a whole (such as a delete or a reload) is kept. When a slow
+    subscriber overflows the queue, its entries are dropped and it is
+    told to reset instead.
+    """
+    def __init__(self, hub, workspace, document=None, kinds=None,
+                 queue_size=1000):
+        self.hub = hub
+        self.workspace = workspace
+        self.document = document
+        self.kinds = set(kinds) if kinds else None
+        self.queue_size = queue_size
+        self.last = 0
+        self.closed = False
+        self._reset = False
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+
+    def accepts(self, entry):
+        if self.kinds is not None and entry['kind'] not in self.kinds:
+            return False
+        if self.document is not None and entry['kind'] != 'variable':
+            return entry['name'] == self.document
+        return True
+
+    def push(self, entries, last):
+        with self._condition:
+            for entry in entries:
+                if self._reset or not self.accepts(entry):
+                    continue
+                if entry['kind'] == 'document':
+                    # A document dropped or to be reloaded must not be
+                    # hidden by what comes after, so these are all kept
+                    key = (entry['kind'], entry['name'], entry['seq'])
+                else:
+                    key = (entry['kind'], entry['name'], entry['row-id'])
+                queued = self._pending.get(key)
+                if queued is not None and queued['seq'] > entry['seq']:
+                    continue
+                self._pending[key] = entry
+                if len(self._pending) > self.queue_size:
+                    self._pending.clear()
+                    self._reset = True
+            if last is not None:
+                self.last = max(self.last, last)
+            if self._pending or self._reset:
+                self._condition.notify()
+
+    def waiting(self):
+        """
+        Tells whether there are changes to get.
+        """
+        with self._condition:
+            return bool(self._pending or self._reset)
+
+    def reset(self):
+        with self._condition:
+            self._pending.clear()
+            self._reset = True
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Waits up to ``timeout`` seconds for changes and returns them as a
+        *grid/change/feed*, or ``None`` if there were none or the
+        subscription was closed.
+        """
+        with self._condition:
+            if not (self._pending or self._reset or self.closed):
+                self._condition.wait(timeout)
+            if self.closed or not (self._pending or self._reset):
+                return None
+            entries = sorted(self._pending.values(), key=lambda e: e['seq'])
+            reset = self._reset
+            self._pending.clear()
+            self._reset = False
+            last = max([self.last] + [entry['seq'] for entry in entries])
+
+        return {
+            'data-type': 'grid/change/feed',
+            'workspace': self.workspace,
+            'last-seq': last,
+            'reset': reset,
+            'more': False,
+            'count': len(entries),
+            'entries': entries,
+        }
+
+    def events(self, heartbeat=15.0, coalesce=0.1):
+        """
+        Yields the changes as Server-Sent Events like
+        :meth:`ChangeHub.stream` writes them, for servers that can't hand
+        the connection over, holding a thread while it lasts.
+        Unsubscribes when the generator is closed.
+        """
+        try:
+            yield b"retry: 3000\n\n"
+            while not self.closed:
+                feed = self.get(heartbeat)
+                if feed is None:
+                    if not self.closed:
+                        yield b": heartbeat\n\n"
+                    continue
+                event = 'reset' if feed['reset'] else 'change'
+                yield ("event: %s\nid: %i\ndata: %s\n\n" % (
+                    event, feed['last-seq'], json.dumps(feed))).encode('utf8')
+                if coalesce:
+                    time.sleep(coalesce)
+        finally:
+            self.hub.unsubscribe(self)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+import json
+
+
+class Journal(object):
+    """
+    Append-only change journal of a workspace, kept in the
+    ``_grid_journal`` table. Triggers record every row inserted, updated
+    or deleted in a document, every change to a variable and every
+    document created, changed or dropped, each with a monotonic sequence
+    number (*seq*). Entries have a *kind* (``data``, ``variable`` or
+    ``document``), the *name* of the document or variable, a *mode*
+    (``insert``, ``update`` or ``delete``), the *row-id* for ``data`` and
+    the new values as *data*.
+
+    While a document is bulk loaded (see :meth:`suspend`) its rows are not
+    journaled one by one; a single ``document`` entry with mode ``reload``
+    tells clients to read it again afterwards.
+
+    Compaction removes old entries and records the highest removed seq as
+    the journal's *watermark* in ``_grid_meta``; a client asking for changes
+    from before the watermark has to start over.
+    """
+    kinds = ('data', 'variable', 'document')
+
+    @classmethod
+    def create(cls, db):
+        db.execute("CREATE TABLE IF NOT EXISTS _grid_journal (" +
+                   "seq INTEGER PRIMARY KEY AUTOINCREMENT, " +
+                   "ts INTEGER DEFAULT (strftime('%s', 'now')), " +
+                   "kind TEXT(16), " +
+                   "name TEXT(128), " +
+                   "mode TEXT(16), " +
+                   "row_id INTEGER, " +
+                   "data TEXT)"
+                  )
+        db.execute("CREATE INDEX IF NOT EXISTS _grid_journal_name " +
+                   "ON _grid_journal (name, seq)")
+        db.execute("INSERT OR IGNORE INTO _grid_meta (name, update_ts) " +
+                   "VALUES ('journal', strftime('%s', 'now'))")
+
+        cls._trigger(db, '_grid_vars', '_grid_vars_journal_insert', 'INSERT',
+                     "'variable', NEW.name, 'insert', NULL, " +
+                     "json_object('type', NEW.type, 'value', NEW.value)")
+        cls._trigger(db, '_grid_vars', '_grid_vars_journal_rename', 'UPDATE',
+                     "'variable', OLD.name, 'delete', NULL, NULL",
+                     "OLD.name != NEW.name")
+        cls._trigger(db, '_grid_vars', '_grid_vars_journal_update', 'UPDATE',
+                     "'variable', NEW.name, 'update', NULL, " +
+                     "json_object('type', NEW.type, 'value', NEW.value)")
+        cls._trigger(db, '_grid_vars', '_grid_vars_journal_delete', 'DELETE',
+                     "'variable', OLD.name, 'delete', NULL, NULL")
+        cls._trigger(db, '_grid_docs', '_grid_docs_journal_insert', 'INSERT',
+                     "'document', NEW.name, 'insert', NULL, NULL")
+        cls._trigger(db, '_grid_docs', '_grid_docs_journal_update', 'UPDATE',
+                     "'document', NEW.name, 'update', NULL, NULL")
+        cls._trigger(db, '_grid_docs', '_grid_docs_journal_delete', 'DELETE',
+                     "'document', OLD.name, 'delete', NULL, NULL")
+
+    @classmethod
+    def create_triggers(cls, db, document, columns):
+        """
+        Creates the triggers journaling the rows of ``document``, whose
+        column names are ``columns``. They go away with the table.
+        """
+        def values(row):
+            # JSON can't hold BLOBs, those are journaled as hex
+            return "json_object(" + ", ".join([
+                "'%s', CASE typeof(%s.%s) WHEN 'blob' THEN hex(%s.%s) ELSE %s.%s END" % (
+                    column, row, column, row, column, row, column)
+                for column in columns]) + ")"
+
+        name = "'" + document + "'"
+        journaling = cls._journaling(document)
+        cls._trigger(db, document, document + '__journal_insert', 'INSERT',
+                     "'data', %s, 'insert', NEW.rowid, %s" % (name, values('NEW')),
+                     journaling)
+        cls._trigger(db, document, document + '__journal_move', 'UPDATE',
+                     "'data', %s, 'delete', OLD.rowid, NULL" % name,
+                     "OLD.rowid != NEW.rowid AND " + journaling)
+        cls._trigger(db, document, document + '__journal_update', 'UPDATE',
+                     "'data', %s, 'update', NEW.rowid, %s" % (name, values('NEW')),
+                     journaling)
+        cls._trigger(db, document, document + '__journal_delete', 'DELETE',
+                     "'data', %s, 'delete', OLD.rowid, NULL" % name,
+                     journaling)
+
+    @classmethod
+    def drop_triggers(cls, db, document):
+        for event in ('insert', 'move', 'update', 'delete'):
+            db.execute("DROP TRIGGER IF EXISTS " + document + '__journal_' + event)
+
+    @classmethod
+    def unguarded(cls, db):
+        """
+        Returns the documents whose triggers predate :meth:`suspend` and
+        journal bulk loads row by row.
+        """
+        suffix = '__journal_insert'
+        return [row['name'][:-len(suffix)] for row in db.execute(
+            "SELECT name FROM sqlite_master WHERE type='trigger' " +
+            "AND substr(name, -?) = ? AND sql NOT LIKE '%bulk:%'",
+            (len(suffix), suffix))]
+
+    @classmethod
+    def suspend(cls, db, document):
+        """
+        Stops journaling the rows of ``document``, for every connection,
+        until :meth:`resume`. Must be committed to take effect.
+        """
+        db.execute("INSERT OR IGNORE INTO _grid_meta (name, update_ts) " +
+                   "VALUES (?, strftime('%s', 'now'))", ('bulk:' + document,))
+
+    @classmethod
+    def resume(cls, db, document):
+        """
+        Journals the rows of ``document`` again and records a ``reload``
+        entry for everything that changed in the meantime.
+        """
+        db.execute("DELETE FROM _grid_meta WHERE name=?", ('bulk:' + document,))
+        db.execute("INSERT INTO _grid_journal (kind, name, mode) " +
+                   "VALUES ('document', ?, 'reload')", (document,))
+
+    @classmethod
+    def _journaling(cls, document):
+        return ("NOT EXISTS (SELECT 1 FROM _grid_meta WHERE name='bulk:%s')" %
+                document)
+
+    @classmethod
+    def _trigger(cls, db, table, trigger, event, values, when=None):
+        db.execute("CREATE TRIGGER IF NOT EXISTS " + trigger +
+                   " AFTER " + event + " ON " + table +
+                   (" WHEN " + when if when else "") + " BEGIN " +
+                   "INSERT INTO _grid_journal (kind, name, mode, row_id, data) " +
+                   "VALUES (" + values + "); END")
+
+    @classmethod
+    def changes(cls, db, since=0, name=None, limit=1000):
+        """
+        Returns the entries after seq ``since`` (optionally only those for
+        the rows and definition of document ``name``), at most ``limit``
+        of them, as a tuple ``(entries, last seq, watermark, more)``.
+        """
+        sql = "SELECT seq, ts, kind, name, mode, row_id, data FROM _grid_journal WHERE seq > ?"
+        params = [since]
+        if name is not None:
+            sql += " AND name=? AND kind IN ('data', 'document')"
+            params.append(name)
+        sql += " ORDER BY seq LIMIT ?"
+        params.append(limit + 1)
+
+        rows = db.execute(sql, params).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        watermark = cls.watermark(db)
+
+        if rows:
+            last = rows[-1]['seq']
+        else:
+            last = max(since, cls.last(db))
+
+        entries = [{
+            'data-type': 'grid/change/entry',
+            'seq': row['seq'],
+            'ts': row['ts'],
+            'kind': row['kind'],
+            'name': row['name'],
+            'mode': row['mode'],
+            'row-id': row['row_id'],
+            'data': json.loads(row['data']) if row['data'] is not None else None,
+        } for row in rows]
+        return entries, last, watermark, more
+
+    @classmethod
+    def latest(cls, db, name):
+        """
+        Returns ``(seq, ts)`` of the newest entry for the rows or the
+        definition of document ``name``, or ``None`` if it has none left.
+        """
+        row = db.execute("SELECT seq, ts FROM _grid_journal " +
+                         "WHERE name=? AND kind IN ('data', 'document') " +
+                         "ORDER BY seq DESC LIMIT 1", (name,)).fetchone()
+        return (row['seq'], row['ts']) if row is not None else None
+
+    @classmethod
+    def last(cls, db):
+        row = db.execute("SELECT seq FROM sqlite_sequence WHERE name='_grid_journal'").fetchone()
+        return row['seq'] if row is not None else 0
+
+    @classmethod
+    def watermark(cls, db):
+        row = db.execute("SELECT version FROM _grid_meta WHERE name='journal'").fetchone()
+        return row['version'] if row is not None else 0
+
+    @classmethod
+    def compact(cls, db, keep):
+        """
+        Removes all but the last ``keep`` entries. Must run in a transaction.
+        """
+        upto = cls.last(db) - keep
+        if upto <= cls.watermark(db):
+            return 0
+        cur = db.execute("DELETE FROM _grid_journal WHERE seq <= ?", (upto,))
+        db.execute("UPDATE _grid_meta SET version=?, update_ts=strftime('%s', 'now') " +
+                   "WHERE name='journal'", (upto,))
+        return cur.rowcount
@@ -1,22 +1,247 @@
 #!/usr/bin/env python3
 
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 
 class DocumentBinding(object):
     """
-    Provides editing and listening capabilities to a 
+    Provides editing and listening capabilities to a
     ``:class:radiant.grid.definition.DocumentDefinition`` using a
     ``:class:radiant.grid.adapter.*``.
+
+    Rows read with :meth:`query` are kept in a :class:`WindowCache` of at
+    most ``budget`` bytes, and the window after (or, when scrolling up,
+    before) the one asked for is read ahead in the background. Changes
+    picked up by :meth:`poll` (or handed to :meth:`apply`) drop the
+    cached windows they affect and are passed on to the listeners.
     """
 
-    def __init__(self, adapter, document):
+    def __init__(self, adapter, document, budget=32 * 1024 * 1024,
+                 read_ahead=True):
         self.adapter = adapter
         self.document = document
+        self.windows = WindowCache(budget)
+        self.read_ahead = read_ahead
+        self._listeners = {}
+        self._last_start = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        # Changes from here on invalidate what gets cached
+        self._seq = adapter.get_changes(0, document.name, limit=0).last_seq
 
     def listen(self, listener, callback):
-        pass
+        """
+        Calls ``callback`` with every :class:`ChangeFeed` holding changes
+        to the document, after the cache has been brought up to date.
+        """
+        self._listeners[id(listener)] = callback
 
     def forget(self, listener):
-        pass
+        self._listeners.pop(id(listener), None)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
 
     def query(self, columns, start, count):
-        data = adapter.get_rows(self.document.name, start, count)
+        """
+        Returns ``count`` rows from ``start`` with the given ``columns``
+        (all if ``None``) as a :class:`DataPage`.
+        """
+        key = tuple(columns) if columns else None
+        page = self.windows.find(key, start, count)
+        if page is None:
+            page = self._wait(key, start, count)
+        if page is None:
+            page = self._load(key, start, count)
+
+        with self._lock:
+            previous = self._last_start.get(key)
+            self._last_start[key] = start
+        if self.read_ahead:
+            if previous is not None and start < previous:
+                if start > 0:
+                    self._prefetch(key, max(0, start - count), count)
+            elif len(page) == count:
+                self._prefetch(key, start + count, count)
+        return page
+
+    def poll(self):
+        """
+        Reads the document's changes since the last poll and applies
+        them, see :meth:`apply`.
+        """
+        while True:
+            changes = self.adapter.get_changes(self._seq, self.document.name)
+            self.apply(changes)
+            if not changes.more:
+                return
+
+    def apply(self, changes):
+        """
+        Drops the cached windows affected by a :class:`ChangeFeed` and
+        calls the listeners if any change concerns the document.
+        """
+        entries = [entry for entry in changes.entries
+                   if entry.name == self.document.name and
+                   entry.kind in ('data', 'document')]
+        if changes.reset or any(entry.kind == 'document' for entry in entries):
+            self.windows.clear()
+        elif entries:
+            self.windows.invalidate(
+                lambda window, page: self._affected(window, page, entries))
+        self._seq = max(self._seq, changes.last_seq)
+
+        if changes.reset or entries:
+            for callback in list(self._listeners.values()):
+                try:
+                    callback(changes)
+                except Exception as e:
+                    print("Error: " + str(e))
+
+    def _affected(self, window, page, entries):
+        # Only when the rows are in rowid order can the rows a change
+        # touches be told apart from the rest
+        if not self._rowid_ordered() or page.row_ids is None:
+            return True
+        count = window[2]
+        for entry in entries:
+            if entry.mode == 'update':
+                if entry.row_id in page.row_ids:
+                    return True
+            # Inserts and deletes move the rows after them, so only full
+            # windows before them stay the same
+            elif not (len(page) == count and len(page) > 0 and
+                      page.row_ids[-1] < entry.row_id):
+                return True
+        return False
+
+    def _rowid_ordered(self):
+        primary_keys = [column for column in self.document.columns.values()
+                        if column.primary_key]
+        return not primary_keys or (primary_keys[0].type_name or '').upper() == 'INTEGER'
+
+    def _load(self, key, start, count):
+        generation = self.windows.generation
+        query = {'columns': list(key)} if key else None
+        page = self.adapter.get_rows(self.document.name, start, count,
+                                     query=query)
+        self.windows.put((key, start, count), page, generation)
+        return page
+
+    def _wait(self, key, start, count):
+        # A window being read ahead is waited for rather than read again
+        with self._lock:
+            future = self._pending.get((key, start, count))
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def _prefetch(self, key, start, count):
+        window = (key, start, count)
+        if self.windows.covers(key, start, count):
+            return
+        with self._lock:
+            if window in self._pending:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='grid-read-ahead')
+            future = self._executor.submit(self._load, key, start, count)
+            self._pending[window] = future
+
+        def done(future):
+            with self._lock:
+                self._pending.pop(window, None)
+        future.add_done_callback(done)
+
+
+class WindowCache(object):
+    """
+    Least recently used windows of rows (:class:`DataPage` objects) keyed
+    by ``(columns, start, count)``, holding at most ``budget`` bytes. A
+    window also serves any range within it, as a slice.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def find(self, key, start, count):
+        """
+        Returns the rows ``start`` to ``start + count`` as a
+        :class:`DataPage` if a cached window holds them, else ``None``.
+        """
+        with self._lock:
+            page = self._lookup(key, start, count)
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return page
+
+    def covers(self, key, start, count):
+        with self._lock:
+            return self._lookup(key, start, count) is not None
+
+    def _lookup(self, key, start, count):
+        window = (key, start, count)
+        entry = self._windows.get(window)
+        if entry is not None:
+            self._windows.move_to_end(window)
+            return entry[0]
+        for window, (page, _) in reversed(self._windows.items()):
+            window_key, window_start, window_count = window
+            if window_key != key or start < window_start:
+                continue
+            # A short window ends at the end of the document
+            if start + count <= window_start + window_count or \
+                    len(page) < window_count:
+                self._windows.move_to_end(window)
+                offset = start - window_start
+                return page[offset:offset + count]
+        return None
+
+    def put(self, window, page, generation):
+        size = page.nbytes()
+        with self._lock:
+            # Read before something was invalidated, so maybe stale
+            if generation != self.generation or size > self.budget:
+                return
+            old = self._windows.pop(window, None)
+            if old is not None:
+                self.size -= old[1]
+            self._windows[window] = (page, size)
+            self.size += size
+            while self.size > self.budget:
+                _, (_, evicted) = self._windows.popitem(last=False)
+                self.size -= evicted
+
+    def invalidate(self, predicate):
+        """
+        Drops the windows for which ``predicate(window, page)`` is true.
+        """
+        with self._lock:
+            self.generation += 1
+            for window, (page, size) in list(self._windows.items()):
+                if predicate(window, page):
+                    del self._windows[window]
+                    self.size -= size
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._windows.clear()
+            self.size = 0
@@ -1,40 +1,283 @@
 #!/usr/bin/env python3
 
+import json
+import time
+import atexit
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from .backend.definition import Feed, VariableDefinition
 
 
 class Scope(object):
-    def __init__(self, adapter):
+    """
+    The variables of a workspace. Listeners are called as soon as a
+    variable is updated, but the new values are written behind: updates
+    are queued, later updates to a variable replace the queued one, and
+    the queue is written in one transaction ``flush_interval`` seconds
+    after the first update, once ``flush_size`` variables are waiting, on
+    :meth:`flush` or :meth:`close`, and at exit.
+
+    Computed variables (see :meth:`compute`) are kept up to date through
+    a dependency graph: a change recomputes only the computed variables
+    downstream of it, each at most once and after everything it reads,
+    and their listeners are called once the graph has settled.
+
+    Listeners are called through the ``dispatcher`` if given (see
+    :class:`Dispatcher`), else right away.
+
+    Names are dot-separated paths (``main.title``); a :class:`Namespace`
+    tree of them serves prefix queries (:meth:`names`, :meth:`values`)
+    and listeners to whole subtrees (:meth:`listen_prefix`).
+
+    All variables are loaded up front unless ``lazy``; then a variable is
+    fetched when first asked for (or with its namespace, see
+    :meth:`load`), and at most ``cache_size`` of those that nothing
+    listens to or depends on are kept, the least recently used going
+    first.
+    """
+    def __init__(self, adapter, flush_interval=0.5, flush_size=100,
+                 dispatcher=None, lazy=False, cache_size=1000):
         self.adapter = adapter
+        self.dispatcher = dispatcher
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
         self._variables = {}
+        self._recent = OrderedDict()
+        self._namespace = Namespace()
         self._listeners = {}
-        variables = self.adapter.get_variables()
-        for variable in variables.entries:
-            self._variables[variable.name] = Variable.from_definition(variable)
+        self._dirty = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dependents = {}
+        self._aggregates = {}
+        self._changed = set()
+        self._forced = set()
+        self._stale = set()
+        self._settled = []
+        self._evaluating = []
+        self._batch = 0
+        self._seq = None
+        atexit.register(self.flush)
+        if not lazy:
+            variables = self.adapter.get_variables()
+            for variable in variables.entries:
+                self._add(Variable.from_definition(variable))
 
     def define(self, name, value=None, type=str):
-        if not name in self._variables.keys():
-            v = Variable(name, value, type)
-            self._variables[name] = v
+        if self._lookup(name) is None:
+            v = self._add(Variable(name, value, type))
             try:
                 self.adapter.create_variable(v.to_definition())
             except NameError:
                 pass
-    
-    def update(self, name, value):
+            if name in self._dependents:
+                self._propagate({name})
+
+    def _add(self, v):
+        v.dispatcher = self.dispatcher
+        v.namespace = self._namespace.insert(v.name)
+        v.namespace.variable = v
+        self._variables[v.name] = v
+        self._touch(v)
+        return v
+
+    def _lookup(self, name):
         v = self._variables.get(name)
+        if v is None and self.lazy:
+            try:
+                v = self._add(Variable.from_definition(
+                    self.adapter.get_variable(name)))
+            except NameError:
+                return None
+        elif v is not None:
+            self._touch(v)
+        return v
+
+    def _touch(self, v):
+        if not self.lazy:
+            return
+        if self._pinned(v):
+            self._recent.pop(v.name, None)
+            return
+        self._recent[v.name] = v
+        self._recent.move_to_end(v.name)
+        unwritten = []
+        while len(self._recent) > self.cache_size:
+            _, old = self._recent.popitem(last=False)
+            # Unwritten updates are kept until written
+            if old.name in self._dirty:
+                unwritten.append(old)
+            elif not self._pinned(old):
+                self._evict(old)
+        for old in reversed(unwritten):
+            self._recent[old.name] = old
+            self._recent.move_to_end(old.name, last=False)
+
+    def _pinned(self, v):
+        return bool(v.listeners or isinstance(v, Computed) or
+                    v.name in self._dependents)
+
+    def _evict(self, v):
+        del self._variables[v.name]
+        namespace = v.namespace
+        namespace.variable = None
+        # Drop the namespaces left with nothing in them
+        while namespace.parent is not None and not (
+                namespace.variable or namespace.children or namespace.listeners):
+            del namespace.parent.children[namespace.name.rpartition('.')[2]]
+            namespace = namespace.parent
+
+    def load(self, prefix):
+        """
+        Loads the variables in namespace ``prefix`` not known yet.
+        """
+        for variable in self.adapter.get_variables(Namespace.strip(prefix)).entries:
+            if variable.name not in self._variables:
+                self._add(Variable.from_definition(variable))
+
+    def compute(self, name, function):
+        """
+        Defines (or redefines) ``name`` as a computed variable whose value
+        is ``function(context)``. The function reads other variables as
+        ``context['name']`` and document aggregates with
+        ``context.aggregate(document, function, column, where)``; what it
+        read is what it depends on. Computed variables aren't stored.
+        """
+        v = self._lookup(name)
+        if v is not None and not isinstance(v, Computed):
+            raise NameError("Already defined: " + name)
+        if v is None:
+            v = self._add(Computed(name, function))
+        v.function = function
+        self._forced.add(name)
+        self._propagate(set())
+
+    @contextmanager
+    def batch(self):
+        """
+        Defers recomputing until the end of the ``with`` block, so that
+        the computed variables are recomputed once for all its updates.
+        """
+        self._batch += 1
+        try:
+            yield self
+        finally:
+            self._batch -= 1
+            if not self._batch:
+                self._settle()
+
+    def update(self, name, value):
+        v = self._lookup(name)
         if v is None:
             raise NameError("Not defined: " + name)
+        if isinstance(v, Computed):
+            raise ValueError("Computed variables can't be updated: " + name)
+        old = v.value
         v.update(value)
-        self.adapter.edit_variable(name, v.to_definition())
+        if name in self._dependents and v.value != old:
+            self._propagate({name})
+        with self._lock:
+            self._dirty[name] = v
+            full = len(self._dirty) >= self.flush_size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval,
+                                              self._flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+        self._touch(v)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the queued updates now. Returns the names of the variables
+        that were renamed or deleted elsewhere meanwhile; their updates
+        are dropped.
+        """
+        # One flush at a time, so that values are written in order
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                dirty, self._dirty = self._dirty, {}
+                definitions = [v.to_definition() for v in dirty.values()]
+            if not definitions:
+                return []
+            try:
+                return self.adapter.edit_variables(definitions) or []
+            except:
+                # Try again with the next flush, unless updated since
+                with self._lock:
+                    for name, v in dirty.items():
+                        self._dirty.setdefault(name, v)
+                raise
+
+    def _flush_later(self):
+        with self._lock:
+            self._timer = None
+        try:
+            missing = self.flush()
+        except Exception as e:
+            print("Error: " + str(e))
+        else:
+            if missing:
+                print("Error: No such variables: " + ", ".join(missing))
+
+    def close(self):
+        """
+        Writes the queued updates and stops writing behind.
+        """
+        atexit.unregister(self.flush)
+        self.flush()
 
     def listen(self, listener, tag, name, callback):
-        v = self._variables.get(name)
+        v = self._lookup(name)
         if v is None:
             raise NameError("Not defined: " + name)
         tag = str(id(listener)) + tag
         l = v.listen(tag, callback)
         self._listeners[tag] = v
+        self._touch(v)
+
+    def listen_prefix(self, listener, tag, prefix, callback):
+        """
+        Calls ``callback(name, value)`` for updates to any variable in
+        namespace ``prefix`` (``main`` or ``main.*``), including variables
+        defined later. Forget with :meth:`nevermind`.
+        """
+        namespace = self._namespace.insert(Namespace.strip(prefix))
+        tag = str(id(listener)) + tag
+        namespace.listen(tag, callback)
+        self._listeners[tag] = namespace
+
+    def names(self, prefix=None):
+        """
+        Returns the sorted names of the variables in namespace ``prefix``
+        (``main`` or ``main.*``), or of all variables.
+        """
+        return sorted(self.values(prefix))
+
+    def values(self, prefix=None):
+        """
+        Returns a dict of the names and values of the variables in
+        namespace ``prefix``, or of all variables.
+        """
+        prefix = Namespace.strip(prefix)
+        values = {}
+        if self.lazy:
+            # Without loading them, the ones here may be newer
+            values = {variable.name: variable.value for variable in
+                      self.adapter.get_variables(prefix or None).entries}
+        namespace = self._namespace.find(prefix)
+        if namespace is not None:
+            values.update((v.name, v.value) for v in namespace.variables())
+        return values
 
     def nevermind(self, listener, tag):
         tag = str(id(listener)) + tag
@@ -42,13 +285,163 @@ class Scope(object):
         if v is not None:
             v.forget(tag)
             self._listeners.pop(tag)
+            if isinstance(v, Variable) and v.name in self._variables:
+                self._touch(v)
 
     def get(self, name):
-        v = self._variables.get(name)
+        v = self._lookup(name)
         if v is None:
             raise NameError("Not defined: " + name)
         return v.value
-        
+
+    def poll(self):
+        """
+        Reads the workspace's changes since the last poll and recomputes
+        the computed variables aggregating the documents that changed.
+        """
+        if self._seq is None:
+            return  # No aggregates read yet
+        documents = set()
+        while True:
+            changes = self.adapter.get_changes(self._seq)
+            if changes.reset:
+                documents.update(key[1] for key in self._dependents
+                                 if isinstance(key, tuple))
+            documents.update(entry.name for entry in changes.entries
+                             if entry.kind in ('data', 'document'))
+            self._seq = changes.last_seq
+            if not changes.more:
+                break
+        for key in list(self._aggregates):
+            if key[0] in documents:
+                del self._aggregates[key]
+        self._propagate(set(('document', document) for document in documents))
+
+    ### Dependency graph ###
+
+    def _propagate(self, changed):
+        self._changed.update(changed)
+        if not self._batch:
+            self._settle()
+
+    def _settle(self):
+        if not (self._changed or self._forced):
+            return
+        # Everything downstream of what changed may have to be recomputed
+        stale = set(self._forced)
+        queue = list(self._changed | self._forced)
+        while queue:
+            for name in self._dependents.get(queue.pop(), ()):
+                if name not in stale:
+                    stale.add(name)
+                    queue.append(name)
+        self._stale = stale
+
+        try:
+            for name in self._topological(stale):
+                if name in self._stale:
+                    self._refresh(name)
+        finally:
+            settled = self._settled
+            self._changed = set()
+            self._forced = set()
+            self._stale = set()
+            self._settled = []
+        for v in settled:
+            v.notify(v.value)
+
+    def _topological(self, names):
+        # Depth first, so every variable comes after the ones it reads
+        order = []
+        visited = set()
+        for name in names:
+            stack = [(name, False)]
+            while stack:
+                name, done = stack.pop()
+                if done:
+                    order.append(name)
+                elif name not in visited:
+                    visited.add(name)
+                    stack.append((name, True))
+                    stack.extend((depend, False)
+                                 for depend in self._variables[name].depends
+                                 if depend in names and depend not in visited)
+        return order
+
+    def _refresh(self, name):
+        self._stale.discard(name)
+        v = self._variables[name]
+        for depend in v.depends & self._stale:
+            if depend in self._stale:
+                self._refresh(depend)
+        # Unchanged inputs give the same (memoised) value
+        if name not in self._forced and not (v.depends & self._changed):
+            return
+        old = v.value
+        self._evaluate(v)
+        if name in self._forced or v.value != old:
+            self._changed.add(name)
+            self._settled.append(v)
+
+    def _evaluate(self, v):
+        context = Context(self)
+        self._evaluating.append(v.name)
+        try:
+            v.value = v.function(context)
+        except Exception as e:
+            v.value = None
+            print("Error: %s: %s" % (v.name, e))
+        finally:
+            self._evaluating.pop()
+
+        if context.depends != v.depends and self._reaches(context.depends, v.name):
+            v.value = None
+            print("Error: %s: Circular dependency" % v.name)
+
+        for depend in v.depends - context.depends:
+            self._dependents[depend].discard(v.name)
+            if not self._dependents[depend]:
+                del self._dependents[depend]
+        for depend in context.depends - v.depends:
+            self._dependents.setdefault(depend, set()).add(v.name)
+        v.depends = context.depends
+
+    def _reaches(self, names, target):
+        visited = set()
+        queue = list(names)
+        while queue:
+            name = queue.pop()
+            if name == target:
+                return True
+            v = self._variables.get(name)
+            if name not in visited and isinstance(v, Computed):
+                visited.add(name)
+                queue.extend(v.depends)
+        return False
+
+    def _read(self, name):
+        if name in self._evaluating:
+            raise ValueError("Circular dependency: " +
+                             " -> ".join(self._evaluating + [name]))
+        if name in self._stale:
+            # A dependency the function did not have before
+            self._refresh(name)
+        return self.get(name)
+
+    def _aggregate(self, document, function, column, where):
+        key = (document, function, column, json.dumps(where, sort_keys=True))
+        if key not in self._aggregates:
+            if self._seq is None:
+                # Changes from here on make aggregates stale, see poll()
+                self._seq = self.adapter.get_changes(0, limit=0).last_seq
+            aggregation = {'aggregates': [{'function': function, 'column': column}]}
+            if where:
+                aggregation['where'] = where
+            feed = self.adapter.aggregate(document, aggregation)
+            name = function if column == '*' else function + '_' + column
+            self._aggregates[key] = feed.entries[0].data[name] if feed.entries else None
+        return self._aggregates[key]
+
 
 class Variable(object):
     def __init__(self, name, value, type):
@@ -56,14 +449,36 @@ class Variable(object):
         self.type = type
         self.listeners = {}
         self.value = value
+        self.dispatcher = None
+        self.namespace = None
     
     def update(self, value):
         self.value = self.type(value)
-        for listener in self.listeners.values():
+        self.notify(value)
+
+    def notify(self, value):
+        if self.dispatcher is not None:
+            for tag in self.listeners:
+                self.dispatcher.post(self, tag, value)
+            namespace = self.namespace
+            while namespace is not None:
+                for tag in namespace.listeners:
+                    self.dispatcher.post(self, tag, value, namespace)
+                namespace = namespace.parent
+            return
+        for listener in list(self.listeners.values()):
             try:
                 listener(value)
             except Exception as e:
                 print("Error: " + str(e))
+        namespace = self.namespace
+        while namespace is not None:
+            for listener in list(namespace.listeners.values()):
+                try:
+                    listener(self.name, value)
+                except Exception as e:
+                    print("Error: " + str(e))
+            namespace = namespace.parent
 
     def listen(self, tag, callback):
         self.listeners[tag] = callback
@@ -93,3 +508,190 @@ class Variable(object):
         else:
             type = str
         return cls(definition.name, definition.value, type)
+
+
+class Namespace(object):
+    """
+    A node in the tree of dot-separated variable names: the variable
+    with its name, if any, the nodes one level below it and the
+    listeners to its whole subtree.
+    """
+    __slots__ = ('name', 'parent', 'children', 'variable', 'listeners')
+
+    def __init__(self, name='', parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        self.variable = None
+        self.listeners = {}
+
+    @staticmethod
+    def strip(prefix):
+        if prefix and prefix.endswith('.*'):
+            return prefix[:-2]
+        return prefix or ''
+
+    def insert(self, name):
+        namespace = self
+        for part in name.split('.') if name else ():
+            child = namespace.children.get(part)
+            if child is None:
+                child = namespace.children[part] = Namespace(
+                    part if namespace.parent is None
+                    else namespace.name + '.' + part, namespace)
+            namespace = child
+        return namespace
+
+    def find(self, name):
+        namespace = self
+        for part in name.split('.') if name else ():
+            namespace = namespace.children.get(part)
+            if namespace is None:
+                return None
+        return namespace
+
+    def variables(self):
+        """
+        Yields the variables in this subtree, in name order.
+        """
+        stack = [self]
+        while stack:
+            namespace = stack.pop()
+            if namespace.variable is not None:
+                yield namespace.variable
+            stack.extend(namespace.children[part] for part in
+                         sorted(namespace.children, reverse=True))
+
+    def listen(self, tag, callback):
+        self.listeners[tag] = callback
+
+    def forget(self, tag):
+        self.listeners.pop(tag)
+
+
+class Dispatcher(object):
+    """
+    Queues listener notifications and calls the listeners later, in one
+    go, with the latest value each: a burst of updates to a variable
+    ends up as one call per listener. ``schedule(drain)`` must arrange
+    for ``drain()`` to be called once, later; see :meth:`tk` for Tk.
+    Without ``schedule``, the queue is only drained by calling
+    :meth:`drain`.
+
+    The counters tell what was saved: *posted* notifications, of which
+    *coalesced* replaced a queued one and *dropped* were for listeners
+    gone by the time of the drain, and *delivered* calls in *drains*
+    drains.
+    """
+    def __init__(self, schedule=None):
+        self.schedule = schedule
+        self.posted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.delivered = 0
+        self.drains = 0
+        self._queue = OrderedDict()
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def tk(cls, widget, frame_rate=None):
+        """
+        Returns a Dispatcher draining when ``widget``'s Tk event loop is
+        idle, or at most ``frame_rate`` times per second.
+        """
+        if not frame_rate:
+            return cls(widget.after_idle)
+
+        interval = 1.0 / frame_rate
+        last = [0.0]
+        def schedule(drain):
+            def frame():
+                last[0] = time.monotonic()
+                drain()
+            delay = last[0] + interval - time.monotonic()
+            widget.after(max(0, int(delay * 1000)), frame)
+        return cls(schedule)
+
+    def post(self, variable, tag, value, namespace=None):
+        """
+        Queues ``value`` for the listener ``tag`` of ``variable``, or with
+        ``namespace`` for that namespace's listener ``tag``.
+        """
+        with self._lock:
+            self.posted += 1
+            key = (variable, tag, namespace)
+            if key in self._queue:
+                self.coalesced += 1
+            self._queue[key] = value
+            if self._scheduled or self.schedule is None:
+                return
+            self._scheduled = True
+        self.schedule(self.drain)
+
+    def drain(self):
+        """
+        Calls the listeners with the values queued for them.
+        """
+        with self._lock:
+            queue, self._queue = self._queue, OrderedDict()
+            self._scheduled = False
+            self.drains += 1
+        for (variable, tag, namespace), value in queue.items():
+            listener = (namespace or variable).listeners.get(tag)
+            if listener is None:
+                self.dropped += 1
+                continue
+            self.delivered += 1
+            try:
+                if namespace is None:
+                    listener(value)
+                else:
+                    listener(variable.name, value)
+            except Exception as e:
+                print("Error: " + str(e))
+
+    def metrics(self):
+        return {
+            'posted': self.posted,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'delivered': self.delivered,
+            'drains': self.drains,
+            'pending': len(self._queue),
+        }
+
+
+class Computed(Variable):
+    """
+    A variable whose value is computed by a function, see
+    :meth:`Scope.compute`. ``depends`` holds the names of the variables
+    (and ``('document', name)`` for the documents) it read last time.
+    """
+    def __init__(self, name, function):
+        Variable.__init__(self, name, None, None)
+        self.function = function
+        self.depends = set()
+
+
+class Context(object):
+    """
+    What the function of a :class:`Computed` variable reads through,
+    noting everything read as a dependency.
+    """
+    def __init__(self, scope):
+        self.scope = scope
+        self.depends = set()
+
+    def __getitem__(self, name):
+        self.depends.add(name)
+        return self.scope._read(name)
+
+    def aggregate(self, document, function='count', column='*', where=None):
+        """
+        Returns the ``function`` (``count``, ``sum``, ``min``, ``max`` or
+        ``avg``) of ``column`` over the rows of ``document`` matching
+        ``where``.
+        """
+        self.depends.add(('document', document))
+        return self.scope._aggregate(document, function, column, where)
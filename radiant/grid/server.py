@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+
+"""
+Production WSGI serving for ``gridserver``: a bounded thread pool with
+HTTP/1.1 keep-alive, a request queue limit and graceful shutdown, plus
+an optional pre-forking mode that runs one such server per worker process
+on a shared listening socket, and response compression.
+"""
+
+import os
+import sys
+import time
+import zlib
+import errno
+import signal
+import socket
+import selectors
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+
+class PoolServerHandler(ServerHandler):
+    """
+    Answers in HTTP/1.1 and keeps the connection open only when the
+    response has a known length and the client wants it open. Sends
+    nothing once the application has taken the connection over.
+    """
+    http_version = "1.1"
+
+    def finish_response(self):
+        if not self.request_handler.detached:
+            return ServerHandler.finish_response(self)
+        self.close()
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        request_handler = self.request_handler
+        # 204 and 304 never have a body, so they need no length
+        bodiless = self.status[:3] in ('204', '304')
+        if 'Content-Length' not in self.headers and not bodiless:
+            request_handler.close_connection = True
+        if request_handler.close_connection or request_handler.server.stopping:
+            request_handler.close_connection = True
+            self.headers['Connection'] = 'close'
+
+
+class PoolRequestHandler(WSGIRequestHandler):
+    """
+    Handles the requests waiting on one connection. When the connection
+    stays open (``keep_alive``) the server waits for its next request
+    without a thread, see :meth:`PoolServer.park`.
+
+    An application can take the connection over by calling
+    ``environ['grid.detach']()``, which returns the socket. The server
+    then neither answers on it nor closes it; the application writes the
+    whole response (see :func:`detached_response`) and closes it.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.timeout = self.server.keepalive_timeout
+        WSGIRequestHandler.setup(self)
+
+    def handle(self):
+        self.close_connection = True
+        self.keep_alive = False
+        self.detached = False
+        self.handle_one_request()
+        # Pipelined requests are handled right away, the next request of
+        # an idle connection may be a long time coming
+        while not self.close_connection and not self.server.stopping and \
+                self.readable():
+            self.handle_one_request()
+        self.keep_alive = not self.close_connection and not self.server.stopping
+
+    def detach(self):
+        self.wfile.flush()
+        self.detached = True
+        self.close_connection = True
+        return self.connection
+
+    def readable(self):
+        """
+        Tells whether the next request has (at least partly) arrived,
+        without waiting for it.
+        """
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+
+        if not self.parse_request():  # An error code has been sent
+            self.close_connection = True
+            return
+
+        environ = self.get_environ()
+        body = RequestBody(self.rfile, environ)
+        environ['wsgi.input'] = body
+        environ['grid.detach'] = self.detach
+
+        handler = PoolServerHandler(
+            body, self.wfile, self.get_stderr(), environ,
+            multithread=True,
+        )
+        handler.request_handler = self  # backpointer for logging
+        handler.run(self.server.get_app())
+
+        if self.detached:
+            return
+        # Whatever the application left unread must go before the next
+        # request can be parsed
+        if not self.close_connection and not body.drain():
+            self.close_connection = True
+        self.wfile.flush()
+
+
+class RequestBody(object):
+    """
+    Request body stream limited to the request's *Content-Length*.
+    """
+    drain_limit = 65536
+
+    def __init__(self, rfile, environ):
+        self.rfile = rfile
+        try:
+            self.remaining = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self.remaining = 0
+        # A chunked body can't be skipped without parsing it
+        self.known = 'chunked' not in environ.get('HTTP_TRANSFER_ENCODING', '')
+
+    def read(self, size=-1):
+        if not self.known:
+            return self.rfile.read(size)
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if not self.known:
+            return self.rfile.readline(size)
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self):
+        """
+        Skips the unread rest of the body. Returns ``False`` if that can't
+        be done cheaply and the connection should be closed instead.
+        """
+        if not self.known or self.remaining > self.drain_limit:
+            return False
+        while self.remaining > 0:
+            if not self.read(self.remaining):
+                return False
+        return True
+
+
+class PoolServer(WSGIServer):
+    """
+    WSGI server handing connections to a pool of ``threads`` threads. At
+    most ``queue_size`` further connections wait for a thread, beyond
+    that new connections are answered with *503 Service Unavailable*.
+
+    Kept-alive connections between requests don't hold a thread: they
+    wait in a selector watched by a single thread, and go back to the
+    pool when the next request arrives, or are closed after
+    ``keepalive_timeout`` seconds.
+    """
+    request_queue_size = 128
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, app, threads=8, queue_size=64,
+                 keepalive_timeout=5.0):
+        WSGIServer.__init__(self, address, PoolRequestHandler)
+        self.set_app(app)
+        self.threads = threads
+        self.queue_size = queue_size
+        self.keepalive_timeout = keepalive_timeout
+        self.stopping = False
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._parking = []
+        self._watcher = None
+        self._wakeup = None
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            if self._executor is None:
+                # Created on first use so that it is never inherited by
+                # a forked worker
+                self._executor = ThreadPoolExecutor(max_workers=self.threads)
+                self._wakeup = socket.socketpair()
+                self._watcher = threading.Thread(
+                    target=self._watch, name='grid-keepalive', daemon=True)
+                self._watcher.start()
+            busy = self._pending >= self.threads + self.queue_size
+            if not busy:
+                self._pending += 1
+
+        if busy:
+            self.reject(request)
+            return
+        self._executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        keep_alive = detached = False
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+            keep_alive = handler.keep_alive
+            detached = handler.detached
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if keep_alive:
+                self.park(request, client_address)
+            elif not detached:
+                self.shutdown_request(request)
+            with self._lock:
+                self._pending -= 1
+
+    def park(self, request, client_address):
+        """
+        Waits for the next request on ``request`` (a connection) in the
+        selector, then hands it to the pool again.
+        """
+        with self._lock:
+            if not self.stopping:
+                self._parking.append((request, client_address))
+                request = None
+        if request is not None:
+            self.shutdown_request(request)
+            return
+        try:
+            self._wakeup[1].send(b'\0')
+        except OSError:
+            pass
+
+    def _watch(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup[0], selectors.EVENT_READ)
+        idle = OrderedDict()  # request: deadline, oldest first
+        try:
+            while not self.stopping:
+                timeout = self.keepalive_timeout
+                if idle:
+                    timeout = max(0.0, next(iter(idle.values())) - time.time())
+                for key, _ in selector.select(timeout):
+                    if key.fileobj is self._wakeup[0]:
+                        try:
+                            self._wakeup[0].recv(4096)
+                        except OSError:
+                            pass
+                        with self._lock:
+                            parking, self._parking = self._parking, []
+                        deadline = time.time() + self.keepalive_timeout
+                        for request, client_address in parking:
+                            selector.register(request, selectors.EVENT_READ,
+                                              client_address)
+                            idle[request] = deadline
+                    else:
+                        # The next request (or the client closing)
+                        selector.unregister(key.fileobj)
+                        del idle[key.fileobj]
+                        self.process_request(key.fileobj, key.data)
+
+                now = time.time()
+                while idle and next(iter(idle.values())) <= now:
+                    request, _ = idle.popitem(last=False)
+                    selector.unregister(request)
+                    self.shutdown_request(request)
+        finally:
+            for request in idle:
+                self.shutdown_request(request)
+            with self._lock:
+                parking, self._parking = self._parking, []
+            for request, _ in parking:
+                self.shutdown_request(request)
+            selector.close()
+
+    def reject(self, request):
+        try:
+            request.sendall(b"HTTP/1.1 503 Service Unavailable\r\n"
+                            b"Content-Length: 0\r\n"
+                            b"Retry-After: 1\r\n"
+                            b"Connection: close\r\n\r\n")
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def stop(self, drain_timeout=30.0):
+        """
+        Stops accepting connections, then waits up to ``drain_timeout``
+        seconds for the requests in progress to finish. Must not be called
+        from the thread running :meth:`serve_forever`.
+        """
+        self.stopping = True
+        self.shutdown()
+        if self._watcher is not None:
+            self._wakeup[1].send(b'\0')
+            self._watcher.join()
+            for end in self._wakeup:
+                end.close()
+        deadline = time.time() + drain_timeout
+        while time.time() < deadline:
+            with self._lock:
+                if self._pending == 0:
+                    break
+            time.sleep(0.05)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.server_close()
+
+
+def detached_response(status, headers, body=None):
+    """
+    Returns the bytes of a response to write on a connection taken over
+    with ``environ['grid.detach']``, which is closed after it. Without a
+    ``body`` the response goes on until then, as a stream.
+    """
+    lines = ['HTTP/1.1 ' + status] + ['%s: %s' % header for header in headers]
+    if body is not None:
+        lines.append('Content-Length: %i' % len(body))
+    lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b'')
+
+
+class Compressor(object):
+    """
+    WSGI middleware compressing responses with gzip or deflate, whichever
+    the client prefers in its *Accept-Encoding*. Only JSON, MessagePack
+    and text bodies of at least ``min_size`` bytes are compressed; event
+    streams and bodies that already have an encoding are passed through.
+    Bodies of unknown length are compressed as they are streamed.
+    """
+    types = ('application/json', 'application/x-ndjson', 'application/msgpack',
+             'text/')
+    encodings = {'gzip': 31, 'deflate': 15}  # zlib wbits of each
+
+    def __init__(self, app, min_size=1024, level=6):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    def negotiate(self, accept_encoding):
+        best, best_q = None, 0.0
+        for part in accept_encoding.split(','):
+            name, _, params = part.strip().partition(';')
+            name = name.strip().lower()
+            if name not in self.encodings:
+                continue
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            # gzip wins ties
+            if q > best_q or (q == best_q and q > 0 and best != 'gzip'):
+                best, best_q = name, q
+        return best
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.app(environ, start_response)
+
+        response = []
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers, exc_info]
+            return lambda data: None  # write() is not supported
+
+        body = self.app(environ, capture)
+        chunks = iter(body)
+        # start_response may be called as late as the first chunk
+        first = next(chunks, None)
+        status, headers, exc_info = response
+        names = {name.lower(): value for name, value in headers}
+        content_type = names.get('content-type', '').split(';')[0].strip()
+
+        compressible = (status[:3] not in ('204', '304') and
+                        'content-encoding' not in names and
+                        content_type != 'text/event-stream' and
+                        content_type.startswith(self.types))
+        length = names.get('content-length')
+        if compressible:
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'vary'] + [
+                ('Vary', ', '.join(filter(None, [names.get('vary'),
+                                                 'Accept-Encoding'])))]
+        if not compressible or (length is not None and int(length) < self.min_size):
+            start_response(status, headers, exc_info)
+            if isinstance(body, (list, tuple)):
+                return body
+            return self._chain(first, chunks, body)
+
+        # The bytes differ, but the content is the same as uncompressed
+        headers = [(name, 'W/' + value if name.lower() == 'etag' and
+                    not value.startswith('W/') else value)
+                   for name, value in headers
+                   if name.lower() != 'content-length']
+        headers.append(('Content-Encoding', encoding))
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      self.encodings[encoding])
+
+        if isinstance(body, (list, tuple)):
+            data = compressor.compress(b''.join(body)) + compressor.flush()
+            headers.append(('Content-Length', str(len(data))))
+            start_response(status, headers, exc_info)
+            if hasattr(body, 'close'):
+                body.close()
+            return [data]
+
+        start_response(status, headers, exc_info)
+        return self._compress(compressor, first, chunks, body)
+
+    def _chain(self, first, chunks, body):
+        try:
+            if first is not None:
+                yield first
+            for chunk in chunks:
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def _compress(self, compressor, first, chunks, body):
+        try:
+            for chunk in self._chain(first, chunks, body):
+                # Flushed per chunk so that streamed output keeps flowing
+                data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+
+def serve(app, host='127.0.0.1', port=8080, threads=8, workers=0,
+          queue_size=64, keepalive_timeout=5.0, drain_timeout=30.0,
+          on_fork=None, on_stop=None):
+    """
+    Serves ``app`` until SIGTERM or SIGINT, then shuts down gracefully.
+
+    With ``workers`` set to 0 a single :class:`PoolServer` runs in this
+    process. Otherwise this process binds the socket and forks ``workers``
+    worker processes, each running its own :class:`PoolServer`, restarting
+    workers that die. ``on_fork`` is called in every new worker, which is
+    the place to drop state such as open database connections.
+    ``on_stop`` is called when shutting down, before waiting for the
+    requests in progress, which is the place to end long-lived responses.
+    """
+    server = PoolServer((host, int(port)), app, threads=threads,
+                        queue_size=queue_size,
+                        keepalive_timeout=keepalive_timeout)
+    if workers:
+        _serve_forked(server, workers, drain_timeout, on_fork, on_stop)
+    else:
+        _serve(server, drain_timeout, on_stop)
+
+
+def _serve(server, drain_timeout, on_stop=None):
+    stopper = []
+
+    def shutdown():
+        if on_stop is not None:
+            on_stop()
+        server.stop(drain_timeout)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever(), so it can't run in the
+        # signal handler on the main thread
+        if not stopper:
+            stopper.append(threading.Thread(target=shutdown))
+            stopper[0].start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        if stopper:
+            stopper[0].join()
+        else:
+            shutdown()
+
+
+def _serve_forked(server, workers, drain_timeout, on_fork, on_stop):
+    children = set()
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            code = 0
+            try:
+                if on_fork is not None:
+                    on_fork()
+                _serve(server, drain_timeout, on_stop)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                break
+            raise
+        children.discard(pid)
+        if not stopping:
+            print("Worker %i exited with status %i, restarting" % (pid, status),
+                  file=sys.stderr)
+            time.sleep(0.1)
+            spawn()
+
+    server.server_close()
@@ -35,7 +35,9 @@ class View(ttk.Frame):
         # Placing Canvas
         self.canvas.place(x=0, y=0)
 
-        # Declare object and title variable
+        # Load the view's own variables, declare object and title variable
+        if self.workspace.scope.lazy:
+            self.workspace.scope.load(self.name)
         self.workspace.scope.define(self.name + '.title', value='untitled')
         self.items = {}
         self._selected_name = None
@@ -6,8 +6,11 @@ from .document import DocumentBinding
 
 
 class Workspace(object):
-    def __init__(self, workspace, server=None, token=None, directory=None):
+    def __init__(self, workspace, server=None, token=None, directory=None,
+                 dispatcher=None, lazy=False):
         self.workspace = workspace
+        self.dispatcher = dispatcher
+        self.lazy = lazy
 
         if directory:
             self.init_local(directory)
@@ -19,7 +22,8 @@ class Workspace(object):
         if workspace is not None:
             try:
                 self.adapter.open_workspace(workspace)
-                self.scope = Scope(self.adapter)
+                self.scope = Scope(self.adapter, dispatcher=self.dispatcher,
+                                   lazy=self.lazy)
             except NameError:
                 self.create_workspace(workspace)
 
@@ -33,7 +37,8 @@ class Workspace(object):
     
     def create_workspace(self, workspace):
         self.adapter.create_workspace(workspace)
-        self.scope = Scope(self.adapter)
+        self.scope = Scope(self.adapter, dispatcher=self.dispatcher,
+                           lazy=self.lazy)
 
         # Create main view with a title label
         view = ViewDefinition()
@@ -58,3 +63,6 @@ class Workspace(object):
     def get_document_binding(self, document_name):
         document = self.adapter.get_document(document_name)
         return DocumentBinding(self.adapter, document)
+
+    def close(self):
+        self.scope.close()
@@ -34,6 +34,9 @@ setup(
                   % (name_, version_)),
     packages=packages_,
     scripts=['bin/grid', 'bin/gridserver'],
+    extras_require={
+        'msgpack': ['msgpack'],
+    },
     classifiers = classifiers
 )
 